@@ -16,15 +16,19 @@ along with this program. If not, see <http://www.gnu.org/licenses/>."""
 
 import os
 import sys
+from collections import OrderedDict
+from multiprocessing import freeze_support
+from queue import Empty, Queue
 from threading import Event, Thread
 import tkinter as tk
 import tkinter.filedialog as tkfiledialog
 from tkinter import ttk
 
-from numpy import array
+import numpy as np
 from PIL import Image, ImageTk
 
 import measurescript as ms
+from tiffstack import TiffStack
 
 # Global Variables
 version = "0.6 Beta"
@@ -32,13 +36,15 @@ regionfiles = []
 spotfiles = []
 regionshortnames = []
 spotshortnames = []
-firstrun = True  # Do we need to write headers to the output file?
 # Parameters for different display modes.
-depthmap = {0: ("8-bit", 1, 256, 16), 1: ("10-bit", 4, 1024, 64), 2: ("12-bit", 16, 4096, 256),
-            3: ("16-bit", 256, 65536, 4096)}  # (ID, multiplier, maxrange, absmin)
+depthmap = ms.depthmap  # (ID, multiplier, maxrange, absmin)
 currentdepthname, scalemultiplier, maxrange, absmin = depthmap[0]
 manualbitdepth = False
 currentdepth = 0
+segcache = ms.SegmentationCache()  # Segmentations shared between overlay previews and analysis runs.
+displayluts = {}  # Lookup tables from raw intensities to 8-bit display values, by (multiplier, dtype).
+displaylimit = 1400  # Widest preview to show, larger images are shown at a smaller scale.
+eventinterval = 40  # Milliseconds between applying queued analysis events to the interface, 25 times a second.
 
 
 # Get path for unpacked Pyinstaller exe (MEIPASS), else default to current dir.
@@ -59,31 +65,47 @@ def resource_path(relative_path):
 # Detect and update scaling factors for displaying images of different bit depths.
 def bit_depth_update(imgarray):
     global depthmap, currentdepth, scalemultiplier, maxrange, absmin, depthname, manualbitdepth
-    maxvalue = imgarray.max()
     if manualbitdepth:
         return scalemultiplier, absmin
-    if maxvalue < 256:
-        depth = 0  # 8-bit
-    elif 256 <= maxvalue < 1024:
-        depth = 1  # 10-bit
-    elif 1024 <= maxvalue < 4096:
-        depth = 2  # 12-bit
-    else:
-        depth = 3  # 16-bit
+    depth = ms.detect_depth(imgarray)
     if currentdepth < depth:
-        name, scalemultiplier, maxrange, absmin = depthmap[depth]
-        currentdepth = depth
-        app.logconfig.logevent("Detected bit depth: " + name)
-        app.regionconfig.threshold.config(to=maxrange)
-        app.spotconfig.threshold.config(to=maxrange)
-        app.regionconfig.default_thresh = absmin
-        app.spotconfig.default_thresh = absmin * 2
-        app.regionconfig.thresh.set(absmin)
-        app.spotconfig.thresh.set(absmin * 2)
-        depthname.set(name)
+        app.logconfig.logevent("Detected bit depth: " + depthmap[depth][0])
+        set_bit_depth(depth)
     return scalemultiplier, absmin
 
 
+# Switch display scaling and threshold limits to a newly detected bit depth.
+def set_bit_depth(depth):
+    global depthmap, currentdepth, scalemultiplier, maxrange, absmin, depthname
+    name, scalemultiplier, maxrange, absmin = depthmap[depth]
+    currentdepth = depth
+    app.regionconfig.threshold.config(to=maxrange)
+    app.spotconfig.threshold.config(to=maxrange)
+    app.regionconfig.default_thresh = absmin
+    app.spotconfig.default_thresh = absmin * 2
+    app.regionconfig.thresh.set(absmin)
+    app.spotconfig.thresh.set(absmin * 2)
+    depthname.set(name)
+
+
+# Fetch the lookup table mapping an image type's intensities to display values for a bit depth.
+def display_lut(multiplier, dtype):
+    key = (multiplier, dtype.str)
+    if key not in displayluts:
+        values = np.arange(np.iinfo(dtype).max + 1) // multiplier
+        displayluts[key] = np.minimum(values, 255).astype('uint8')  # Clip anything brighter than the bit depth.
+    return displayluts[key]
+
+
+# Build display copies of a plane at 1/2, 1/4, 1/8... scale. The plane is subsampled before conversion, so only
+# displayed pixels are looked up.
+def build_pyramid(imgarray, lut, levels=4):
+    pyramid = [lut[imgarray[::2, ::2]]]
+    for level in range(1, levels):
+        pyramid.append(pyramid[-1][::2, ::2])
+    return pyramid
+
+
 # Core UI
 class CoreWindow:
     # Core tabbed GUI
@@ -468,9 +490,8 @@ class InputTab(tk.Frame):
             return
         app.logconfig.logevent("Directory not selected")
 
-    # Generate file lists.
-    def populate_file_list(self):
-        global regionfiles, spotfiles, regionshortnames, spotshortnames
+    # Keywords chosen for region and spot files.
+    def get_keywords(self):
         if self.region_keyword.get() == "Custom":
             regionkwd = self.region_custom_text.get()
         else:
@@ -479,9 +500,32 @@ class InputTab(tk.Frame):
             spotkwd = self.spot_custom_text.get()
         else:
             spotkwd = self.spot_keyword.get()
-        regionfiles, spotfiles, regionshortnames, spotshortnames = ms.genfilelist(self.loaddir.get(),
-                                                                                  self.subdiron.get(), regionkwd,
-                                                                                  spotkwd, self.searchtype.get())
+        return regionkwd, spotkwd
+
+    # Generate file lists.
+    def populate_file_list(self):
+        regionkwd, spotkwd = self.get_keywords()
+        # Scan in the background so the interface stays responsive while large directory trees are searched.
+        self.gen_filelist.state(['disabled'])
+        self.scanresult = None
+        scan_thread = Thread(target=self.scan_files, args=(self.loaddir.get(), self.subdiron.get(), regionkwd,
+                                                           spotkwd, self.searchtype.get()))
+        scan_thread.setDaemon(True)
+        scan_thread.start()
+        self.after(100, self.finish_file_list)
+
+    # Search for files, remembering directory contents in the file index to speed up later searches.
+    def scan_files(self, *params):
+        self.scanresult = ms.genfilelist(*params, ms.FileIndex(ms.fileindexpath))
+
+    # Check whether a search has finished, and if so fill in the file lists.
+    def finish_file_list(self):
+        global regionfiles, spotfiles, regionshortnames, spotshortnames
+        if self.scanresult is None:
+            self.after(100, self.finish_file_list)
+            return
+        regionfiles, spotfiles, regionshortnames, spotshortnames = self.scanresult
+        self.gen_filelist.state(['!disabled'])
         self.update_file_list()
 
     # Populate list boxes and fill in missing files.
@@ -543,8 +587,11 @@ class ImageViewer(tk.Frame):
         self.previewfile = None
         self.previewfiletitle = ""
         self.image = None
+        self.segstages = {}  # Intermediate segmentation results, so overlays update quickly as settings change.
         self.im = None
         self.im2 = None
+        self.displayscale = 2  # Image pixels per displayed pixel.
+        self.pyramids = OrderedDict()  # Display pyramids of recently viewed planes.
         self.numplanes = 0
         self.planeid = 1
         self.temppreview = None
@@ -684,6 +731,23 @@ class ImageViewer(tk.Frame):
         self.minsizescale.grid(column=1, row=1, padx=5)
         self.setminsize = ttk.Entry(self.minsizelabel, textvariable=self.minsize, justify=tk.CENTER, )
         self.setminsize.grid(column=1, row=2, sticky=tk.S)
+        # Whether automatic thresholds are calculated for each plane or shared across a stack or batch.
+        self.scopelabel = ttk.Label(self.segcontrols, text="Threshold For:")
+        self.scopelabel.grid(column=5, row=4, pady=(0, 5), sticky=tk.E)
+        self.scopebox = ttk.Combobox(self.segcontrols, state="readonly", width=14)
+        self.scopebox['values'] = ('Each plane', 'Each stack', 'Whole batch')
+        self.scopebox.current(0)
+        self.scopebox.grid(column=6, row=4, columnspan=2, pady=(0, 5), sticky=tk.W)
+
+        # Peak filter used for automatic spot thresholds.
+        self.prefilterbox = None
+        if self.type == "spot":
+            self.prefilterlabel = ttk.Label(self.segcontrols, text="Peak Filter:")
+            self.prefilterlabel.grid(column=2, row=4, pady=(0, 5), sticky=tk.E)
+            self.prefilterbox = ttk.Combobox(self.segcontrols, state="readonly", width=22)
+            self.prefilterbox['values'] = ('Disk (original)', 'Square (faster)', 'Downsampled (fastest)')
+            self.prefilterbox.current(0)
+            self.prefilterbox.grid(column=3, row=4, columnspan=2, pady=(0, 5), sticky=tk.W)
         self.threshold_mode()
         self.regenprev.config(command=self.initiate_overlay)
         self.toggleoverlay.config(command=self.toggle_overlay)
@@ -729,7 +793,7 @@ class ImageViewer(tk.Frame):
             return
         self.planeid = 1
         if self.previewfile != "<No File Found>":
-            self.image = Image.open(self.previewfile)
+            self.image = TiffStack(self.previewfile)
         self.regen_preview()
         self.update_file("none")
         self.firstview = False
@@ -757,10 +821,20 @@ class ImageViewer(tk.Frame):
             self.overlayon = False
             self.toggleoverlay.state(['!pressed'])
             return
-        self.im = array(self.image)
+        self.im = self.image.plane(self.planeid - 1)
         multiplier, absolute_min = bit_depth_update(self.im)
-        self.im2 = (self.im / multiplier).astype('uint8')
-        self.im2 = self.im2[::2, ::2]
+        key = (self.previewfile, self.planeid, multiplier)
+        pyramid = self.pyramids.pop(key, None)
+        if pyramid is None:
+            pyramid = build_pyramid(self.im, display_lut(multiplier, self.im.dtype))
+        self.pyramids[key] = pyramid
+        if len(self.pyramids) > 16:
+            self.pyramids.popitem(last=False)
+        level = 0
+        while level < len(pyramid) - 1 and pyramid[level].shape[1] > displaylimit:
+            level += 1
+        self.displayscale = 2 ** (level + 1)
+        self.im2 = pyramid[level]
         self.temppreview = Image.fromarray(self.im2)
         self.preview = ImageTk.PhotoImage(self.temppreview)
         self.previewpane.config(image=self.preview)
@@ -774,11 +848,9 @@ class ImageViewer(tk.Frame):
             self.numplanes = 0
         if direction == "fwd":
             self.planeid += 1
-            self.image.seek(self.planeid - 1)
             self.regen_preview()
         elif direction == "rev":
             self.planeid -= 1
-            self.image.seek(self.planeid - 1)
             self.regen_preview()
         elif self.previewfile == "<No File Found>":
             self.planenumber.config(text="Plane 00 of 00")
@@ -844,9 +916,12 @@ class ImageViewer(tk.Frame):
         else:
             self.previewfile = self.imagepool[self.fileid]
             self.previewfiletitle = self.imagenamepool[self.fileid]
+        if self.image:
+            self.image.close()
+        self.planeid = 1
         if self.previewfile != "<No File Found>":
             try:
-                self.image = Image.open(self.previewfile)
+                self.image = TiffStack(self.previewfile)
             except OSError:
                 self.previewfile = "<Invalid File Format>"
         self.regen_preview()
@@ -881,9 +956,10 @@ class ImageViewer(tk.Frame):
             self.progress_var.set(0)
             return
         # Return 8 bit array for display
-        seg_settings = (self.segtype.get(), self.thresh.get(), self.smooth.get(), self.minsize.get())
-        labelled = ms.getseg(self.im, seg_settings, self.type, True)
-        miniseg = labelled[::2, ::2]
+        seg_settings = self.get_settings()
+        labelled = ms.getseg(self.im, seg_settings, self.type, True, (scalemultiplier, absmin), segcache,
+                             (self.previewfile, self.planeid - 1), self.segstages)
+        miniseg = labelled[::self.displayscale, ::self.displayscale]
         self.segoverlay = Image.fromarray(miniseg)
         if self.overlayon is False:  # Abandon overlaying if mode already changed
             return
@@ -929,12 +1005,20 @@ class ImageViewer(tk.Frame):
         self.threshold.state([stateset])
         self.setthr.state([stateset])
 
+    # Package the segmentation settings chosen in this tab.
+    def get_settings(self):
+        prefilter = ms.spotprefilters[self.prefilterbox.current()] if self.prefilterbox else 'rank'
+        scope = ms.thresholdscopes[self.scopebox.current()]
+        return ms.SegSettings(self.segtype.get(), self.thresh.get(), self.smooth.get(), self.minsize.get(), prefilter,
+                              scope)
+
     # Get pixel intensity under the mouse pointer.
     def mouse_hover(self, event):
         if self.previewfile not in ("<No File Found>", "<Invalid File Format>", None):
             ymax, xmax = self.im.shape
-            if event.y * 2 < ymax and event.x * 2 < xmax:
-                pixel = self.im[event.y * 2][event.x * 2]
+            y, x = event.y * self.displayscale, event.x * self.displayscale
+            if y < ymax and x < xmax:
+                pixel = self.im[y][x]
                 self.currpixel.set(pixel)
         else:
             self.currpixel.set(0)
@@ -946,6 +1030,9 @@ class OutputTab(tk.Frame):
         self.already_finished = False
         self.savestatus = False
         self.previewdirstatus = False
+        # Log messages and progress updates, which may come from other threads, wait here for the Tk thread.
+        self.events = Queue()
+        self.after(eventinterval, self.drain_events)
         self.outputcontrols = ttk.Frame(target)
         self.outputcontrols.pack(pady=10)
 
@@ -990,6 +1077,75 @@ class OutputTab(tk.Frame):
         self.singleplaneentry.grid(column=2, row=4, columnspan=1, sticky=tk.W)
         self.singleplanecheck.config(command=self.toggle_single_plane)
         self.singleplaneentry.state(['disabled'])
+        self.workerlabel = ttk.Label(self.outputcontrols, text="Worker processes:")
+        self.workerlabel.grid(column=7, row=4, columnspan=3, sticky=tk.E)
+        self.workerbox = ttk.Combobox(self.outputcontrols, state="readonly", width=3)
+        self.workerbox['values'] = tuple(range(1, (os.cpu_count() or 1) + 1))
+        self.workerbox.current(0)
+        self.workerbox.grid(column=10, row=4, sticky=tk.E)
+        self.formatlabel = ttk.Label(self.outputcontrols, text="Also save results as:")
+        self.formatlabel.grid(column=1, row=5, sticky=tk.W)
+        self.formatbox = ttk.Combobox(self.outputcontrols, state="readonly", width=12)
+        self.formatbox['values'] = ('CSV only',) + tuple('CSV + .' + fmt for fmt in ms.columnarformats)
+        self.formatbox.current(0)
+        self.formatbox.grid(column=2, row=5, columnspan=2, sticky=tk.W)
+        self.cachelabel = ttk.Label(self.outputcontrols, text="Segmentation cache (MB):")
+        self.cachelabel.grid(column=7, row=5, columnspan=3, sticky=tk.E)
+        self.cachebox = ttk.Combobox(self.outputcontrols, state="readonly", width=5)
+        self.cachebox['values'] = (0, 128, 256, 512, 1024, 2048)
+        self.cachebox.current(2)
+        self.cachebox.grid(column=10, row=5, sticky=tk.E)
+        self.cachebox.bind("<<ComboboxSelected>>", self.cache_size_set)
+        self.profileon = tk.BooleanVar()
+        self.profileon.set(False)
+        self.profilecheck = ttk.Checkbutton(self.outputcontrols, text="Record time and memory used by each stage",
+                                            variable=self.profileon, onvalue=True, offvalue=False)
+        self.profilecheck.grid(column=1, row=6, columnspan=4, sticky=tk.W)
+        self.lowmemory = tk.BooleanVar()
+        self.lowmemory.set(False)
+        self.lowmemorycheck = ttk.Checkbutton(self.outputcontrols, text="Low memory mode", variable=self.lowmemory,
+                                              onvalue=True, offvalue=False)
+        self.lowmemorycheck.grid(column=1, row=7, columnspan=4, sticky=tk.W)
+        self.tilelabel = ttk.Label(self.outputcontrols, text="Segment large images in tiles of:")
+        self.tilelabel.grid(column=7, row=7, columnspan=3, sticky=tk.E)
+        self.tilebox = ttk.Combobox(self.outputcontrols, state="readonly", width=5)
+        self.tilebox['values'] = ('Off', 1024, 2048, 4096, 8192)
+        self.tilebox.current(0)
+        self.tilebox.grid(column=10, row=7, sticky=tk.E)
+        self.resumeon = tk.BooleanVar()
+        self.resumeon.set(False)
+        self.resumecheck = ttk.Checkbutton(self.outputcontrols, text="Resume an interrupted run into this log file",
+                                           variable=self.resumeon, onvalue=True, offvalue=False)
+        self.resumecheck.grid(column=1, row=8, columnspan=4, sticky=tk.W)
+        self.watchon = tk.BooleanVar()
+        self.watchon.set(False)
+        self.watchcheck = ttk.Checkbutton(self.outputcontrols, text="Watch input directory for new images",
+                                          variable=self.watchon, onvalue=True, offvalue=False)
+        self.watchcheck.grid(column=7, row=8, columnspan=4, sticky=tk.E)
+        self.focuslabel = ttk.Label(self.outputcontrols, text="Only analyse the sharpest planes:")
+        self.focuslabel.grid(column=1, row=9, columnspan=2, sticky=tk.W)
+        self.focusbox = ttk.Combobox(self.outputcontrols, state="readonly", width=5)
+        self.focusbox['values'] = ('Off', 1, 2, 3, 5)
+        self.focusbox.current(0)
+        self.focusbox.grid(column=3, row=9, sticky=tk.W)
+        self.projectionlabel = ttk.Label(self.outputcontrols, text="Project planes of each stack:")
+        self.projectionlabel.grid(column=7, row=9, columnspan=3, sticky=tk.E)
+        self.projectionbox = ttk.Combobox(self.outputcontrols, state="readonly", width=5)
+        self.projectionbox['values'] = ('Off', 'Max', 'Mean', 'Sum')
+        self.projectionbox.current(0)
+        self.projectionbox.grid(column=10, row=9, sticky=tk.E)
+        self.measurelabel = ttk.Label(self.outputcontrols, text="Measure spots by:")
+        self.measurelabel.grid(column=1, row=10, columnspan=2, sticky=tk.W)
+        self.measurebox = ttk.Combobox(self.outputcontrols, state="readonly", width=22)
+        self.measurebox['values'] = ('Line to perimeter', 'Distance to nearest edge')
+        self.measurebox.current(0)
+        self.measurebox.grid(column=3, row=10, columnspan=2, sticky=tk.W)
+        self.layoutlabel = ttk.Label(self.outputcontrols, text="Result images:")
+        self.layoutlabel.grid(column=7, row=6, columnspan=2, sticky=tk.E)
+        self.layoutbox = ttk.Combobox(self.outputcontrols, state="readonly", width=22)
+        self.layoutbox['values'] = ('One file per spot', 'One stack per plane', 'One contact sheet per plane')
+        self.layoutbox.current(0)
+        self.layoutbox.grid(column=9, row=6, columnspan=2, sticky=tk.E)
         self.outputcontrols.grid_columnconfigure(3, weight=1)
 
         # Run button
@@ -1034,10 +1190,14 @@ class OutputTab(tk.Frame):
         self.currlog.bind("<Button-1>", self.save_file_set)
         self.prevdir.bind("<Button-1>", self.preview_directory_set)
         self.widgetslist = [self.logselect, self.currlog, self.prevsaveselect, self.prevdir, self.prevsavecheck,
-                            self.singlespotcheck, self.singleplanecheck, self.singleplaneentry]
+                            self.singlespotcheck, self.singleplanecheck, self.singleplaneentry, self.workerbox,
+                            self.formatbox, self.profilecheck, self.layoutbox, self.lowmemorycheck,
+                            self.tilebox, self.resumecheck, self.watchcheck, self.focusbox,
+                            self.projectionbox, self.measurebox]
         self.filelimit = 0
         self.planelimit = 0
         self.celllimit = 0
+        self.run = None
 
     # Restrict text entry in plane selector to number only.
     def validate(self, action, index, value_if_allowed, prior_value, input, validation_type, trigger_type, widget_name):
@@ -1067,31 +1227,63 @@ class OutputTab(tk.Frame):
         return
 
     # Pushes message to log box.
+    # Add a message to the log. Like update_progress, this is safe to call from any thread.
     def logevent(self, text):
-        self.logbox.insert(tk.END, str(text))
-        self.logbox.see(tk.END)
+        self.events.put(('log', text))
+
+    # Apply queued log messages and progress updates to the interface. Runs on the Tk thread every eventinterval ms,
+    # so the analysis thread never touches Tk itself. Messages are added together, and consecutive cell updates are
+    # merged into one.
+    def drain_events(self):
+        lines = []
+        cells = 0
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except Empty:
+                break
+            if event[0] == 'log':
+                lines.append(str(event[1]))
+            elif event[1] == 'cell':
+                cells += 1
+            else:
+                if cells:
+                    self.show_progress('cell', cells)
+                    cells = 0
+                self.show_progress(event[1], event[2])
+        if cells:
+            self.show_progress('cell', cells)
+        if lines:
+            self.logbox.insert(tk.END, *lines)
+            self.logbox.see(tk.END)
+        if self.run is not None and self.run.currentdepth > currentdepth and not manualbitdepth:
+            set_bit_depth(self.run.currentdepth)  # Detected during the run.
+        self.after(eventinterval, self.drain_events)
 
     # Set save file.
     def save_file_set(self, *unusedargs):
-        global firstrun
         logfile = None
         try:
-            logfile = tkfiledialog.asksaveasfile(mode='w', defaultextension='.csv', initialfile='output.csv',
-                                                 title='Save output file')
+            logfile = tkfiledialog.asksaveasfilename(defaultextension='.csv', initialfile='output.csv',
+                                                     title='Save output file')
+            if logfile:
+                # Check it can be written to without emptying it, so an interrupted run into it can be resumed.
+                with open(logfile, 'a'):
+                    pass
         except AttributeError:
+            logfile = None
             self.logevent("Save path appears to be invalid")
         except PermissionError:
+            logfile = None
             self.logevent("Cannot write to save file, please make sure it isn't open in another program.")
         except OSError:
+            logfile = None
             self.logevent("OSError, failed to write to save file.")
         if logfile:
-            logfile.close()
-            self.logtext.set(logfile.name)
+            self.logtext.set(logfile)
             self.savestatus = True
             self.logevent("Save file set successfully.")
-            firstrun = True
-            ms.indexnum = 0
-            ms.cellnum = 0
+            self.run = None  # Start numbering afresh in the new file.
         else:
             self.savestatus = False
             self.logtext.set("Create a data log file")
@@ -1113,16 +1305,22 @@ class OutputTab(tk.Frame):
         if self.prevsavon.get() is True:
             self.prevsaveselect.state(['!disabled'])
             self.prevdir.state(['!disabled'])
+            self.layoutbox.state(['!disabled'])
         else:
             self.prevsaveselect.state(['disabled'])
             self.prevdir.state(['disabled'])
+            self.layoutbox.state(['disabled'])
         return
 
     # Check ALL parameters are set before trying to initiate a run.
     # If all is ok, write headers, lock interface and create work thread.
     def sanity_check(self):
         global regionfiles, spotfiles, regionshortnames, spotshortnames
-        if len(regionfiles) < 1 or len(spotfiles) < 1:
+        watching = self.watchon.get()
+        if watching and not os.path.isdir(app.input.loaddir.get()):
+            self.logevent("Unable to run: No input directory to watch")
+            return
+        if not watching and (len(regionfiles) < 1 or len(spotfiles) < 1):
             self.logevent("Unable to run: No file list generated")
             return
         if os.path.exists(self.logtext.get()) is False:
@@ -1140,7 +1338,7 @@ class OutputTab(tk.Frame):
         finalspotfiles = [file for index, file in enumerate(spotfiles) if
                           regionfiles[index] != "<No File Found>" and spotfiles[index] != "<No File Found>"]
         filesremoved = (len(regionfiles) - len(finalregionfiles))
-        if filesremoved > 0:
+        if filesremoved > 0 and not watching:
             self.logevent(f"{filesremoved} unpaired files will be skipped")
         self.logevent("Pre-run checks complete. Initiating script")
         self.listprogress.config(maximum=len(regionfiles))
@@ -1157,34 +1355,63 @@ class OutputTab(tk.Frame):
         self.currlog.unbind("<Button 1>")
         self.prevdir.unbind("<Button 1>")
         self.already_finished = False
-        global process_stopper, firstrun
-        if firstrun:
-            ms.headers(self.logtext.get())
-            firstrun = False
+        global process_stopper
+        columnar = ms.columnarformats[self.formatbox.current() - 1] if self.formatbox.current() > 0 else None
+        newrun = self.run is None or self.resumeon.get()  # Resuming reloads the file's journal.
+        if newrun:
+            self.run = ms.AnalysisRun(self.logtext.get(), logevent=self.logevent, update_progress=self.update_progress,
+                                      segcache=segcache)
+        self.run.previewdir = self.previewsavedir.get()
+        self.run.previewlayout = ms.previewlayouts[self.layoutbox.current()]
+        self.run.measuremode = ms.measuremodes[self.measurebox.current()]
+        self.run.writer.columnar = columnar
+        self.run.currentdepth = currentdepth
+        self.run.manualdepth = manualbitdepth
+        self.run.profiler = ms.StageProfiler() if self.profileon.get() else None
+        # Write headers on the first run into a file, later runs carry on from there. Interrupted runs can be picked
+        # up where they stopped instead.
+        if newrun and not (self.resumeon.get() and self.run.resume()):
+            self.run.headers()
         process_stopper = Event()
         process_stopper.set()
-        work_thread = Thread(target=self.start_analysis,
-                             args=(process_stopper, finalregionfiles, finalspotfiles))
+        # Settings are read here, as the analysis thread mustn't touch Tk.
+        focusplanes = 0 if self.focusbox.current() == 0 else int(self.focusbox.get())
+        projection = ms.projections[self.projectionbox.current() - 1] if self.projectionbox.current() > 0 else None
+        output_params = (self.prevsavon.get(), self.one_plane.get(), (self.desiredplane.get() - 1), focusplanes,
+                         projection)
+        tilesize = 0 if self.tilebox.current() == 0 else int(self.tilebox.get())
+        region_settings = app.regionconfig.get_settings()._replace(lowmemory=self.lowmemory.get(), tilesize=tilesize)
+        spot_settings = app.spotconfig.get_settings()._replace(lowmemory=self.lowmemory.get(), tilesize=tilesize)
+        if watching:  # File lists are ignored, new images are paired up by name as they arrive.
+            regionkwd, spotkwd = app.input.get_keywords()
+            work_thread = Thread(target=ms.watchfolder,
+                                 args=(self.run, app.input.loaddir.get(), app.input.subdiron.get(), regionkwd,
+                                       spotkwd, app.input.searchtype.get(), region_settings, spot_settings,
+                                       output_params, self.one_per_cell.get(), process_stopper),
+                                 kwargs={'workers': int(self.workerbox.get())})
+        else:
+            work_thread = Thread(target=ms.cyclefiles,
+                                 args=(self.run, finalregionfiles, finalspotfiles, region_settings, spot_settings,
+                                       output_params, self.one_per_cell.get(), process_stopper),
+                                 kwargs={'workers': int(self.workerbox.get())})
         work_thread.setDaemon(True)
         work_thread.start()
 
+    # Change how much memory cached segmentations may use.
+    def cache_size_set(self, *unusedargs):
+        segcache.resize(int(self.cachebox.get()) * 2 ** 20)
+
     # Flag to abort an analysis.
     def abort_analysis(self):
         process_stopper.clear()
         self.logevent("Aborting run")
 
-    # Package thresholding settings and start analysis.
-    def start_analysis(self, stopper, regioninput, spotinput):
-        output_params = (self.prevsavon.get(), self.one_plane.get(), (self.desiredplane.get() - 1))
-        region_settings = (app.regionconfig.segtype.get(), app.regionconfig.thresh.get(), app.regionconfig.smooth.get(),
-                           app.regionconfig.minsize.get())
-        spot_settings = (app.spotconfig.segtype.get(), app.spotconfig.thresh.get(), app.spotconfig.smooth.get(),
-                         app.spotconfig.minsize.get())
-        ms.cyclefiles(regioninput, spotinput, region_settings, spot_settings, output_params,
-                      self.previewsavedir.get(), self.one_per_cell.get(), stopper)
-
-    # Update progress bars.
+    # Queue an update for the progress bars.
     def update_progress(self, updatetype, limit):
+        self.events.put(('progress', updatetype, limit))
+
+    # Update progress bars. Cell updates advance by limit cells.
+    def show_progress(self, updatetype, limit):
         if updatetype == "file":
             self.planelimit = limit
             self.planeprogress.config(maximum=self.planelimit)
@@ -1202,7 +1429,7 @@ class OutputTab(tk.Frame):
                     'Plane %(planeid)02d of %(totalplanes)02d' % {'planeid': self.planeprogressvar.get(),
                                                                   'totalplanes': self.planelimit}))
         elif updatetype == "cell":
-            self.cellprogressvar.set(self.cellprogressvar.get() + 1)
+            self.cellprogressvar.set(self.cellprogressvar.get() + limit)
             self.celllisttext.config(text=(
                     'Cell %(cellid)02d of %(totalcells)02d' % {'cellid': self.cellprogressvar.get(),
                                                                'totalcells': self.celllimit}))
@@ -1238,13 +1465,11 @@ def main():
     global app
     root = tk.Tk()
     app = CoreWindow(root)
-    ms.logevent = app.logconfig.logevent
-    ms.update_progress = app.logconfig.update_progress
-    ms.bit_depth_update = bit_depth_update
     root.mainloop()
 
 
 if __name__ == "__main__":
+    freeze_support()  # Worker processes need this in frozen builds.
     main()
 
 # TODO  - Text limit on mac list boxes. Widen.
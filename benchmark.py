@@ -0,0 +1,234 @@
+# Benchmarks for the analysis pipeline, run on reproducible synthetic images.
+# Generates region/spot stacks, times segmentation, per-plane analysis and whole runs, and can save the results as a
+# JSON baseline to compare later runs against. Spot threshold peak filters are compared for speed and agreement.
+# Usage: python benchmark.py [--size 1024] [--save baseline.json] [--compare baseline.json]
+
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from threading import Event
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage as ndi
+
+import measurescript as ms
+from tiffstack import TiffStack
+
+region_settings = ("High", 16, 10, 1000)
+spot_settings = ("Low", 32, 1, 10)
+
+
+# Draw a filled disk of the given value into an image.
+def drawdisk(image, center, radius, value):
+    rows, cols = np.ogrid[:image.shape[0], :image.shape[1]]
+    image[(rows - center[0]) ** 2 + (cols - center[1]) ** 2 <= radius ** 2] = value
+
+
+# Generate one plane of cells and spots. Intensities are scaled to fill the requested bit depth.
+def makeplane(rng, size, numcells, spotspercell, bitdepth):
+    scale = (2 ** bitdepth - 1) / 4095  # Intensities below are chosen for 12-bit images.
+    region = np.zeros((size, size))
+    spot = np.zeros((size, size))
+    numspots = 0
+    for cell in range(numcells):
+        radius = rng.randint(15, 30)
+        center = rng.randint(radius + 10, size - radius - 10, 2)
+        drawdisk(region, center, radius, rng.uniform(2000, 2500))
+        for i in range(spotspercell):
+            angle = rng.uniform(0, 2 * np.pi)
+            distance = rng.uniform(0, radius * 0.8)
+            spotcenter = (int(center[0] + distance * np.sin(angle)), int(center[1] + distance * np.cos(angle)))
+            drawdisk(spot, spotcenter, 2.5, rng.uniform(1500, 2300))
+            numspots += 1
+    region = ndi.gaussian_filter(region, 1.5) + rng.normal(100, 20, region.shape)
+    spot = ndi.gaussian_filter(spot, 1) + rng.normal(100, 20, spot.shape)
+    dtype = np.uint8 if bitdepth == 8 else np.uint16
+    region = np.clip(region * scale, 0, 2 ** bitdepth - 1).astype(dtype)
+    spot = np.clip(spot * scale, 0, 2 ** bitdepth - 1).astype(dtype)
+    return region, spot, numspots
+
+
+def savestack(planes, path):
+    images = [Image.fromarray(plane) for plane in planes]
+    images[0].save(path, save_all=True, append_images=images[1:])
+
+
+# Write synthetic image pairs to a directory. Returns the region and spot file lists.
+def makedata(directory, params):
+    rng = np.random.RandomState(params['seed'])
+    numcells = max(1, int(round(params['density'] * params['size'] ** 2 / 1e6)))
+    regionfiles, spotfiles = [], []
+    for filenum in range(params['files']):
+        regions, spots = [], []
+        for planenum in range(params['planes']):
+            region, spot, numspots = makeplane(rng, params['size'], numcells, params['spots'], params['bitdepth'])
+            regions.append(region)
+            spots.append(spot)
+        regionfiles.append(os.path.join(directory, f"bench{filenum:03d}_Blue.tif"))
+        spotfiles.append(os.path.join(directory, f"bench{filenum:03d}_Red.tif"))
+        savestack(regions, regionfiles[-1])
+        savestack(spots, spotfiles[-1])
+    return regionfiles, spotfiles
+
+
+def loadplanes(regionfiles, spotfiles):
+    planes = []
+    for regionfile, spotfile in zip(regionfiles, spotfiles):
+        with TiffStack(regionfile) as regionstack, TiffStack(spotfile) as spotstack:
+            for i in range(regionstack.n_frames):
+                planes.append((regionstack.plane(i).copy(), spotstack.plane(i).copy()))
+    return planes
+
+
+def newrun(directory):
+    return ms.AnalysisRun(os.path.join(directory, "benchmark.csv"), logevent=lambda text: None)
+
+
+# Time a function over several repeats, keeping the fastest. The function returns a dict of counts to report
+# throughput for, which should be the same every repeat.
+def timed(function, repeats):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        counts = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    result = {'seconds': best}
+    for name, count in counts.items():
+        result[name] = count
+        result[name + '/s'] = count / best if best > 0 else 0
+    return result
+
+
+def runbenchmarks(params, directory):
+    regionfiles, spotfiles = makedata(directory, params)
+    planes = loadplanes(regionfiles, spotfiles)
+    numpixels = sum(region.size for region, spot in planes)
+    depth = ms.depthmap[ms.detect_depth(planes[0][0])][1::2]
+    stopper = Event()
+    stopper.set()
+
+    def segment(imgtype, settings, channel):
+        def function():
+            for plane in planes:
+                ms.getseg(plane[channel], settings, imgtype, False, depth)
+            return {'pixels': numpixels}
+        return function
+
+    def cells():
+        run = newrun(directory)
+        for planeid, (region, spot) in enumerate(planes):
+            run.currplane = planeid
+            multiplier, absolute_min = run.bit_depth_update(region)
+            ms.cyclecells(run, region, spot, region_settings, spot_settings, False, False, stopper, multiplier)
+            run.flushdata()
+        run.writer.finish()
+        return {'pixels': numpixels, 'cells': run.cellnum, 'spots': run.indexnum}
+
+    def files():
+        run = newrun(directory)
+        run.headers()
+        ms.cyclefiles(run, regionfiles, spotfiles, region_settings, spot_settings, (False, False, 0, 0, None), False,
+                      stopper)
+        return {'pixels': numpixels, 'cells': run.cellnum, 'spots': run.indexnum}
+
+    # Spot thresholds with each peak filter. Agreement with the original rank filter is reported alongside.
+    thresholds = {}
+
+    def spotthreshold(prefilter):
+        settings = ms.SegSettings(*spot_settings[:4], prefilter)
+
+        def function():
+            thresholds[prefilter] = [ms.findthreshold(spot, settings, 'spot', depth) for region, spot in planes]
+            return {'pixels': numpixels}
+        return function
+
+    benchmarks = (('getseg-region', segment('region', region_settings, 0)),
+                  ('getseg-spot', segment('spot', spot_settings, 1)),
+                  ('cyclecells', cells),
+                  ('cyclefiles', files)) + tuple(
+        ('prefilter-' + prefilter, spotthreshold(prefilter)) for prefilter in ms.spotprefilters)
+    results = {}
+    for name, function in benchmarks:
+        if params['only'] and name not in params['only']:
+            continue
+        results[name] = timed(function, params['repeats'])
+        note = ""
+        if name.startswith('prefilter-') and 'rank' in thresholds:
+            differences = [abs(threshold - original) / original * 100 for threshold, original in
+                           zip(thresholds[name[len('prefilter-'):]], thresholds['rank'])]
+            results[name]['threshold_difference_percent'] = {'mean': float(np.mean(differences)),
+                                                             'max': float(np.max(differences))}
+            note = f"  thresholds {np.mean(differences):.1f}% (max {np.max(differences):.1f}%) from rank"
+        print(f"{name:<23}{results[name]['seconds']:>9.3f} s" + "".join(
+            f"{results[name][unit + '/s']:>14.1f} {unit}/s" for unit in ('pixels', 'cells', 'spots')
+            if unit in results[name]) + note)
+    return results
+
+
+# Compare results against a saved baseline. Returns the names of benchmarks which got slower than the tolerance.
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline['results']:
+            continue
+        ratio = baseline['results'][name]['seconds'] / result['seconds']
+        status = "ok"
+        if ratio < 1 - tolerance:
+            status = "SLOWER"
+            regressions.append(name)
+        print(f"{name:<23}{ratio:>8.2f}x baseline speed  {status}")
+    return regressions
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark the analysis pipeline on synthetic images.")
+    parser.add_argument("--size", type=int, default=1024, help="image width and height in pixels")
+    parser.add_argument("--bitdepth", type=int, choices=(8, 10, 12, 16), default=12)
+    parser.add_argument("--density", type=float, default=100, help="cells per megapixel")
+    parser.add_argument("--spots", type=int, default=3, help="spots per cell")
+    parser.add_argument("--planes", type=int, default=3, help="planes per stack")
+    parser.add_argument("--files", type=int, default=2, help="number of stack pairs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3, help="report the fastest of this many runs")
+    parser.add_argument("--only", nargs="+", help="only run these benchmarks")
+    parser.add_argument("--data", help="directory to keep the generated images in")
+    parser.add_argument("--save", help="save results as a JSON baseline")
+    parser.add_argument("--compare", help="compare results with a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction slower than the baseline which counts as a regression")
+    args = parser.parse_args(argv)
+    params = {name: getattr(args, name) for name in
+              ('size', 'bitdepth', 'density', 'spots', 'planes', 'files', 'seed', 'repeats', 'only')}
+
+    if args.data:
+        os.makedirs(args.data, exist_ok=True)
+        results = runbenchmarks(params, args.data)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = runbenchmarks(params, directory)
+
+    report = {'parameters': params, 'results': results, 'python': sys.version.split()[0],
+              'numpy': np.__version__, 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['parameters'] != params:
+            print("Warning: baseline was recorded with different parameters")
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
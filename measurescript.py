@@ -1,12 +1,20 @@
+import json
 import os
-from csv import writer as csvwriter
-from math import hypot
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from csv import reader as csvreader, writer as csvwriter
+from math import ceil, hypot, sqrt
+from multiprocessing import get_context
+from queue import Queue
+from threading import Event, Lock, Thread
 
 import numpy as np
-import skimage.measure
 from PIL import Image
 from scipy import ndimage as ndi
-from skimage.color import label2rgb
 from skimage.draw import line
 from skimage.feature import peak_local_max
 from skimage.filters import threshold_li, threshold_otsu
@@ -14,17 +22,162 @@ from skimage.filters.rank import maximum
 from skimage.morphology import watershed, remove_small_holes, remove_small_objects, disk
 from skimage.segmentation import clear_border, find_boundaries
 
+from tiffstack import TiffStack
+
 # Global Variables
-currplane = 1
-indexnum = 0
-cellnum = 0
-savedir = ""
-previewdir = ""
-imgfile = ""
+validmodes = ('I;8', 'I;16', 'L')
+nostage = nullcontext()  # Stands in for profiled stages when profiling is off.
+# Segmentation settings for a channel. Prefilter is one of spotprefilters, used when picking spot thresholds.
+# Scope is one of thresholdscopes, and samples is how many pixels per plane (or per tile of tiled planes) to pool
+# for stack, batch and tiled thresholds (0 for all of them). Lowmemory works through objects one at a time where
+# possible, in single precision and in place, which more than halves peak memory use. The lower precision
+# occasionally moves where touching objects are split apart. Images larger than tilesize (0 for no limit) are
+# segmented in tiles of that size, each with a margin of tilehalo pixels around it, see tiledsegment. getseg also
+# accepts plain (method, threshold, smoothing, minsize) tuples, using the defaults for the rest.
+SegSettings = namedtuple('SegSettings', ('method', 'threshold', 'smoothing', 'minsize', 'prefilter', 'scope',
+                                         'samples', 'lowmemory', 'tilesize', 'tilehalo'),
+                         defaults=('rank', 'plane', 100000, False, 0, 256))
+# Measurements of each object in a label image, as arrays in label order, see measureobjects. Centroids are pairs of
+# arrays of row and column coordinates, the weighted centroid using pixel intensities as weights. Bounding boxes are
+# pairs of slices, as from ndi.find_objects.
+ObjectMeasures = namedtuple('ObjectMeasures', ('area', 'centroid', 'weightedcentroid', 'intensity', 'meanintensity',
+                                               'bbox'))
+measureblock = 2 ** 18  # Pixels measured at a time, see measureobjects.
+# Ways to find local peaks for automatic spot thresholds: a rank maximum over a disk on an 8-bit copy of the image
+# (the original method), a square maximum filter, or a maximum filter on an image downsampled by taking the
+# brightest pixel of each 4x4 block. The last two work on full intensities and are much faster.
+spotprefilters = ('rank', 'square', 'downsampled')
+# Automatic thresholds can be calculated for each plane separately, or once for each stack or the whole batch from
+# pixels pooled across all of their planes. Shared thresholds are steadier and skip per-plane threshold calculation.
+thresholdscopes = ('plane', 'stack', 'batch')
+focussize = 512  # Planes are shrunk to at most this many pixels across to measure how well focused they are.
+# Ways to project the planes chosen from a stack onto one image before analysis, see projectplanes.
+projections = ('max', 'mean', 'sum')
+# Ways to measure how far into its cell each spot is: along the line from the cell's centroid through the spot to the
+# perimeter (the original method), or from a distance transform of each cell, see measuredistances.
+measuremodes = ('perimeter', 'distance')
+# Parameters for different display modes.
+depthmap = {0: ("8-bit", 1, 256, 16), 1: ("10-bit", 4, 1024, 64), 2: ("12-bit", 16, 4096, 256),
+            3: ("16-bit", 256, 65536, 4096)}  # (ID, multiplier, maxrange, absmin)
+
+
+# Find the display depth needed to show an image.
+def detect_depth(imgarray):
+    maxvalue = imgarray.max()
+    if maxvalue < 256:
+        return 0  # 8-bit
+    elif maxvalue < 1024:
+        return 1  # 10-bit
+    elif maxvalue < 4096:
+        return 2  # 12-bit
+    return 3  # 16-bit
+
+
+class AnalysisRun:
+    # Everything one analysis needs to carry through the pipeline: counters, the results writer, where to save
+    # result images and callbacks for reporting back. Separate runs share nothing, so several can run in one process.
+    # Callbacks default to console output for use without the GUI.
+    def __init__(self, logfile=None, previewdir="", columnar=None, logevent=None, update_progress=None,
+                 bit_depth_update=None, segcache=None, profile=None, previewlayout='files', measuremode='perimeter'):
+        self.currplane = 0
+        self.indexnum = 0
+        self.cellnum = 0
+        self.imgfile = ""
+        self.previewdir = previewdir
+        self.previewlayout = previewlayout  # One of previewlayouts.
+        self.measuremode = measuremode  # One of measuremodes.
+        self.previews = None  # PreviewWriter saving result images in the background while a run is in progress.
+        self.writer = ResultWriter(logfile, columnar, self) if logfile else None
+        self.journal = RunJournal(os.path.splitext(logfile)[0] + '_journal.jsonl') if logfile else None
+        self.settingskey = None  # Identifies the settings planes are being analysed with, see RunJournal.
+        self.currentdepth = 0
+        self.manualdepth = False
+        self.segcache = segcache  # Optional SegmentationCache shared with the viewer.
+        # Optional StageProfiler, recording time ('time') or time and memory use ('memory') of each stage.
+        self.profiler = StageProfiler(profile == 'memory') if profile else None
+        if logevent is not None:
+            self.logevent = logevent
+        if update_progress is not None:
+            self.update_progress = update_progress
+        if bit_depth_update is not None:
+            self.bit_depth_update = bit_depth_update
+
+    def logevent(self, text):
+        print(text)
+
+    def update_progress(self, updatetype, limit):
+        if updatetype == "finished":
+            self.logevent("Analysis complete!" if limit != 0 else "Analysis aborted")
+
+    # Track the bit depth of images seen so far, unless it was set manually.
+    def bit_depth_update(self, imgarray):
+        if not self.manualdepth:
+            depth = detect_depth(imgarray)
+            if depth > self.currentdepth:
+                self.currentdepth = depth
+                self.logevent("Detected bit depth: " + depthmap[depth][0])
+        name, multiplier, maxrange, absmin = depthmap[self.currentdepth]
+        return multiplier, absmin
+
+    # Write the output file's headers, starting a new journal.
+    def headers(self):
+        if self.writer is not None:
+            self.writer.headers()
+            self.journal.start()
+
+    # Carry on from where an earlier run into the same output file stopped, using its journal. Results written after
+    # its last completed plane are removed, and counters and bit depth continue from that plane. Planes it completed
+    # with the same settings are then skipped. Returns False if there's nothing to resume, in which case call
+    # headers() to start afresh.
+    def resume(self):
+        if self.writer is None or not os.path.isfile(self.writer.path):
+            return False
+        entry = self.journal.load(os.path.getsize(self.writer.path))
+        if entry is None:
+            return False
+        self.writer.truncate(entry['offset'])
+        self.cellnum = entry['cellnum']
+        self.indexnum = entry['indexnum']
+        if not self.manualdepth:
+            self.currentdepth = max(self.currentdepth, entry['depth'])
+        self.logevent(f"Resuming after {len(self.journal.done)} completed planes")
+        return True
+
+    # Whether a plane was completed by an earlier run with the current settings.
+    def isdone(self, imgfile, planeid):
+        return self.journal is not None and self.journal.done.get((imgfile, planeid)) == self.settingskey
+
+    # Record the current plane as complete, once all of its results are written out.
+    def checkpoint(self):
+        if self.writer is not None and not self.writer.rows:
+            self.journal.record(self)
+
+    # Queue data for writing to the output file
+    def datawriter(self, exportdata):
+        writeme = (self.imgfile, self.currplane + 1, self.cellnum, self.indexnum + 1) + exportdata
+        if self.writer is None:
+            self.logevent("Output file has not been set up")
+            return
+        self.writer.addrow(writeme)
+
+    # Write out any queued results, e.g. once a plane is finished.
+    def flushdata(self):
+        if self.writer is not None:
+            self.writer.flush()
+        if self.previews is not None:
+            self.previews.endplane()
+
+    # Save a result image for the latest spot.
+    def betterpreview(self, regioninput, spotinput, centcoord, perimcoord, spotcoord, name, multiplier):
+        if self.previews is not None:
+            self.previews.add((regioninput, spotinput, centcoord, perimcoord, spotcoord, multiplier), name)
+        else:
+            betterpreview(regioninput, spotinput, centcoord, perimcoord, spotcoord, self.previewdir + str(name),
+                          multiplier)
 
 
 # Preview generator for debugging
-def genpreview(tgt, name):
+def genpreview(tgt, name, previewdir=""):
     preview = Image.fromarray(tgt)
     savetgt = previewdir + name + ".tif"
     preview.save(savetgt)
@@ -32,8 +185,16 @@ def genpreview(tgt, name):
 
 
 # Generate mini preview files as RGB overlays
-def betterpreview(regioninput, spotinput, centcoord, perimcoord, spotcoord, name, multiplier):
-    global previewdir
+def betterpreview(regioninput, spotinput, centcoord, perimcoord, spotcoord, savename, multiplier):
+    rgb = previewimage(regioninput, spotinput, centcoord, perimcoord, spotcoord, multiplier)
+    preview = Image.fromarray(rgb)
+    savetgt = savename + ".tif"
+    preview.save(savetgt)
+
+
+# Draw a cell's region (blue) and spot (green) channels with the measured line (red) between the cell's centroid and
+# perimeter. The centroid, perimeter point and spot are marked in white.
+def previewimage(regioninput, spotinput, centcoord, perimcoord, spotcoord, multiplier):
     p, q = line(perimcoord[0], perimcoord[1], centcoord[0], centcoord[1])
     green = np.zeros_like(regioninput)
     green[p, q] = 255
@@ -44,134 +205,638 @@ def betterpreview(regioninput, spotinput, centcoord, perimcoord, spotcoord, name
     rgb[centcoord[0], centcoord[1]] = 255
     rgb[perimcoord[0], perimcoord[1]] = 255
     rgb[spotcoord[0], spotcoord[1]] = 255
-    preview = Image.fromarray(rgb)
-    savetgt = previewdir + str(name) + ".tif"
-    preview.save(savetgt)
+    return rgb
+
+
+# Create segmentation of image. Depth is the (multiplier, absolute_min) pair for the image's bit depth.
+# With a cache and a source (an identifier for the image, e.g. its file and plane) previous results are reused.
+# Passing a stages dict as well keeps intermediate results, so that when settings are tweaked only the steps after
+# the changed setting are rerun. A StageProfiler records how long each step takes.
+def getseg(imagearray, settings, imgtype, preview_mode, depth=None, cache=None, source=None, stages=None,
+           profiler=None):
+    if depth is None:
+        depth = depthmap[detect_depth(imagearray)][1::2]
+    settings = SegSettings(*settings)
+    key = None
+    cached = None
+    if cache is not None and source is not None:
+        key = (source, imgtype, tuple(settings), tuple(depth))
+        cached = cache.get(key)
+    if cached is None:
+        cached = segment(imagearray, settings, imgtype, depth, stages if source is not None else None, source,
+                         profiler)
+        if key is not None:
+            cache.put(key, cached)
+    segmentation, threshold = cached
+    if preview_mode:
+        from skimage.color import label2rgb  # Only needed by the GUI, keep it out of batch start up.
+        imagearray2 = np.where(imagearray < threshold, 0, imagearray)  # Remove background
+        labelled = label2rgb(segmentation, image=imagearray2, bg_label=0, bg_color=(0, 0, 0), kind='overlay')
+        labelled = (labelled * 256).astype('uint8')
+        return labelled
+    with stage(profiler, imgtype + ' measurement'):
+        labels, measures = measureobjects(segmentation, imagearray)
+    return segmentation, measures, labels
+
+
+# Measure every object in a label image at once. Returns an array of the labels used, in order, and their
+# ObjectMeasures. Sums are gathered a block of rows at a time, so memory use stays low even for very large images.
+def measureobjects(segmentation, imagearray):
+    size = int(segmentation.max()) + 1
+    sums = np.zeros((6, size))  # Pixels, intensity, rows, columns, intensity weighted rows and columns.
+    height, width = segmentation.shape
+    step = max(1, measureblock // width)
+    cols = np.tile(np.arange(width, dtype=np.float64), step)
+    for start in range(0, height, step):
+        owners = segmentation[start:start + step].ravel()
+        values = imagearray[start:start + step].ravel().astype(np.float64)
+        rows = np.repeat(np.arange(start, start + step, dtype=np.float64), width)[:owners.size]
+        sums[0] += np.bincount(owners, minlength=size)
+        for i, weights in enumerate((values, rows, cols[:owners.size], values * rows, values * cols[:owners.size])):
+            sums[i + 1] += np.bincount(owners, weights, minlength=size)
+    labels = np.flatnonzero(sums[0][1:]) + 1
+    area, intensity, rows, cols, weightedrows, weightedcols = sums[:, labels]
+    area = area.astype(np.int64)  # Pixel counts, as regionprops gives them.
+    bboxes = ndi.find_objects(segmentation)
+    return labels, ObjectMeasures(area, (rows / area, cols / area),
+                                  (weightedrows / intensity, weightedcols / intensity), intensity, intensity / area,
+                                  [bboxes[label - 1] for label in labels])
+
+
+# Threshold and watershed an image. Returns the label image and the threshold which was used.
+# Each stage is keyed on the source image and the settings it depends on, see runstage.
+def segment(imagearray, settings, imgtype, depth, stages=None, source=None, profiler=None):
+    automatic, threshold, smoothing, minsize, prefilter, scope, samples, lowmemory, tilesize, tilehalo = settings
+    tiled = tilesize and max(imagearray.shape) > tilesize
+    if tiled:  # Tiles aren't kept as stages.
+        labels, threshold = tiledsegment(imagearray, settings, imgtype, depth, profiler)
+    else:
+        # A manual threshold is only an input when thresholding isn't automatic.
+        key = (source, imgtype, tuple(depth), automatic, threshold if automatic == "Manual" else None, prefilter)
+        with stage(profiler, imgtype + ' threshold'):
+            threshold = runstage(stages, 'threshold', key, findthreshold, imagearray, settings, imgtype, depth,
+                                 profiler)
+        key = (source, threshold, lowmemory)
+        with stage(profiler, imgtype + ' distance transform'):
+            binary, distance = runstage(stages, 'distance', key, finddistance, imagearray, threshold, lowmemory)
+        key += (smoothing,)
+        with stage(profiler, imgtype + ' watershed'):
+            labels = runstage(stages, 'watershed', key, splitobjects, binary, distance, smoothing)
+        del binary, distance  # Release these before filtering, unless kept as stages.
+    with stage(profiler, imgtype + ' size filter'):
+        if tiled or lowmemory and stages is None:  # Nothing else holds the labels, so filter them in place.
+            sizes = np.bincount(labels.ravel())
+            toosmall = sizes < minsize
+            toosmall[0] = False
+            labels[toosmall[labels]] = 0
+            segmentation = labels
+        else:
+            segmentation = remove_small_objects(labels, min_size=minsize)
+    segmentation.flags.writeable = False  # May be shared through a cache.
+    return segmentation, threshold
+
 
+# Run a segmentation stage, or reuse its last result if the stage's inputs (summarised by key) are unchanged.
+def runstage(stages, name, key, function, *args):
+    if stages is not None:
+        lastkey, result = stages.get(name, (None, None))
+        if lastkey == key:
+            return result
+    result = function(*args)
+    if stages is not None:
+        stages[name] = (key, result)
+    return result
 
-# Create segmentation of image
-def getseg(imagearray, settings, imgtype, preview_mode):  # Segments input images
-    automatic, threshold, smoothing, minsize = settings
-    multiplier, absolute_min = bit_depth_update(imagearray)
-    imagearray2 = imagearray.copy()
+
+# Pick the threshold separating objects from background.
+def findthreshold(imagearray, settings, imgtype, depth, profiler=None):
+    automatic, threshold, smoothing, minsize, prefilter, scope, samples, lowmemory, tilesize, tilehalo = settings
+    multiplier, absolute_min = depth
     if automatic != "Manual":
-        if imgtype == "region":
-            if automatic == "High":
-                threshold = threshold_li(imagearray2)  # li > otsu for finding threshold when background is low
-            elif automatic == "Low":
-                threshold = threshold_otsu(imagearray2)
-        elif imgtype == "spot":
+        values, scale = thresholdvalues(imagearray, imgtype, multiplier, prefilter, profiler)
+        threshold = autothreshold(values, automatic) * scale
+        if imgtype == "spot":
             absolute_min *= 2
-            imgmax = maximum(imagearray2 // multiplier, disk(10))
-            if automatic == "High":
-                threshold = (threshold_li(imgmax) * multiplier)  # Generate otsu threshold for peaks.
-            elif automatic == "Low":
-                threshold = (threshold_otsu(imgmax) * multiplier)
         if absolute_min > threshold:
             threshold = absolute_min  # Set a minimum threshold in case an image is blank.
-    mask = imagearray2 < threshold
-    imagearray2[mask] = 0  # Remove background
-    binary = imagearray2 > 0
+    return threshold
+
+
+# Apply shared thresholds for a scope ('stack' or 'batch') to both channels. Pairs lists (region file, spot file,
+# plane IDs) for the files covered, with their planes projected first if a projection is set. Returns the new region
+# and spot settings and a log message for each changed.
+def sharedthresholds(run, pairs, region_settings, spot_settings, scope, stopper, projection=None):
+    newsettings = []
+    notes = []
+    for settings, imgtype, index in ((region_settings, 'region', 0), (spot_settings, 'spot', 1)):
+        planesources = [(pair[index], pair[2]) for pair in pairs]
+        shared = sharedthreshold(run, planesources, settings, imgtype, scope, stopper, projection)
+        if shared.method != SegSettings(*settings).method:
+            notes.append(f"Using {imgtype} threshold {shared.threshold:.1f} for this {scope}")
+        newsettings.append(shared)
+    return newsettings[0], newsettings[1], notes
+
+
+# Values automatic thresholds are picked from, with the factor to scale thresholds found from them back to image
+# intensities. Regions use the image itself, spots use the brightest pixels around each point (their peaks).
+def thresholdvalues(imagearray, imgtype, multiplier, prefilter, profiler=None):
+    if imgtype == "spot":
+        with stage(profiler, imgtype + ' maximum filter'):
+            return spotpeaks(imagearray, multiplier, prefilter)
+    return imagearray, 1
+
+
+def autothreshold(values, automatic):
+    if automatic == "High":
+        return threshold_li(values)  # li > otsu for finding threshold when background is low
+    return threshold_otsu(values)
+
+
+# Calculate an automatic threshold shared by a set of planes, from values pooled from a random sample of pixels in
+# each (see SegSettings). Planesources lists (file, plane IDs) pairs, see planegroups for projection. Files without
+# planes, which getplanes found unreadable or unsuitable, are left out. If the settings use this scope, returns them
+# with the shared threshold set as a manual one. Otherwise, or if the run is stopped, the settings are unchanged.
+def sharedthreshold(run, planesources, settings, imgtype, scope, stopper, projection=None):
+    settings = SegSettings(*settings)
+    if settings.scope != scope or settings.method == "Manual":
+        return settings
+    rng = np.random.RandomState(0)  # Sample the same pixels each time for repeatable results.
+    pooled = []
+    depth = None
+    for path, planes in planesources:
+        if not planes:
+            continue
+        with TiffStack(path) as stack:
+            for planeids in planegroups(planes, projection).values():
+                if not stopper.is_set():
+                    return settings
+                image = projectplanes(stack, planeids, projection)
+                depth = run.bit_depth_update(image)
+                values, scale = thresholdvalues(image, imgtype, depth[0], settings.prefilter)
+                pooled.append(samplevalues(values, settings.samples, rng).astype(np.float32) * scale)
+    if not pooled:
+        return settings
+    return settings._replace(method="Manual", threshold=pooledthreshold(pooled, settings.method, imgtype, depth))
+
+
+# Take a random sample of threshold values, or all of them if samples is 0.
+def samplevalues(values, samples, rng):
+    values = values.ravel()
+    if 0 < samples < values.size:
+        values = values[rng.randint(0, values.size, samples)]
+    return values
+
+
+# Pick an automatic threshold from values pooled from several planes or tiles. Scale converts it back to image
+# intensities, see thresholdvalues.
+def pooledthreshold(pooled, automatic, imgtype, depth, scale=1):
+    threshold = autothreshold(np.concatenate(pooled), automatic) * scale
+    absolute_min = depth[1] * 2 if imgtype == "spot" else depth[1]
+    if absolute_min > threshold:
+        threshold = absolute_min
+    return threshold
+
+
+# Find the brightest pixel around each point of a spot image, using one of spotprefilters. Returns the filtered
+# image and the factor to scale thresholds found from it back to image intensities.
+def spotpeaks(imagearray, multiplier, prefilter='rank'):
+    if prefilter == 'square':
+        return ndi.maximum_filter(imagearray, size=21), 1
+    elif prefilter == 'downsampled':
+        height, width = (imagearray.shape[0] // 4) * 4, (imagearray.shape[1] // 4) * 4
+        blocks = imagearray[:height, :width].reshape(height // 4, 4, width // 4, 4).max(axis=(1, 3))
+        return ndi.maximum_filter(blocks, size=5), 1
+    return maximum(imagearray // multiplier, disk(10)), multiplier
+
+
+# Mask out the background and find each object pixel's distance from it.
+# In low memory mode the distances are found one object at a time and kept in single precision.
+def finddistance(imagearray, threshold, lowmemory=False):
+    binary = imagearray >= threshold  # Remove background
+    binary &= imagearray > 0
     binary = remove_small_holes(binary, min_size=1000)  # Clear up any holes
-    distance = ndi.distance_transform_edt(binary)  # Use smoothed distance transform to find the midpoints.
+    if lowmemory:
+        distance = objectdistance(binary)
+    else:
+        distance = ndi.distance_transform_edt(binary)  # Use smoothed distance transform to find the midpoints.
+    return binary, distance
+
+
+# Watershed touching objects apart, seeded from the peaks of the smoothed distance map.
+def splitobjects(binary, distance, smoothing):
+    labels = floodobjects(binary, distance, findmarkers(distance, smoothing))
+    if distance.dtype == np.float32:  # Low memory mode, the labels aren't shared so can be cleared in place.
+        return clearedges(labels)
+    return clear_border(labels)  # Remove segments touching borders
+
+
+# Label the peaks of the smoothed distance map, one marker for each segment.
+def findmarkers(distance, smoothing):
     blurred = ndi.gaussian_filter(distance, sigma=smoothing)
     local_maxi = peak_local_max(blurred, indices=False)
-    markers = ndi.label(local_maxi)[0]  # Apply labels to each peak
-    labels = watershed(-distance, markers, mask=binary)  # Watershed segment
-    segmentation = clear_border(labels)  # Remove segments touching borders
-    segmentation = remove_small_objects(segmentation, min_size=minsize)
-    if preview_mode:
-        labelled = label2rgb(segmentation, image=imagearray2, bg_label=0, bg_color=(0, 0, 0), kind='overlay')
-        labelled = (labelled * 256).astype('uint8')
-        return labelled
-    labels = np.unique(segmentation)[1:]
-    properties = skimage.measure.regionprops(segmentation, intensity_image=imagearray)
-    return segmentation, properties, labels
+    del blurred
+    return ndi.label(local_maxi)[0]  # Apply labels to each peak
+
+
+# Flood objects from their markers. Single precision distances (from low memory mode) are watershed one object at a
+# time.
+def floodobjects(binary, distance, markers):
+    if distance.dtype == np.float32:
+        return objectwatershed(distance, markers, binary)
+    return watershed(-distance, markers, mask=binary)  # Watershed segment
+
+
+# Distance transform of each separate object in turn, in single precision. The nearest background pixel to any point
+# in an object is always within a pixel of its bounding box, so this matches distance_transform_edt while only
+# needing working space for the largest object.
+def objectdistance(binary):
+    objects = ndi.label(binary)[0]
+    distance = np.zeros(binary.shape, np.float32)
+    for label, box in enumerate(ndi.find_objects(objects), 1):
+        window = tuple(slice(max(side.start - 1, 0), side.stop + 1) for side in box)
+        inside = objects[window] == label
+        distance[window][inside] = ndi.distance_transform_edt(binary[window])[inside]
+    return distance
+
+
+# Watershed each separate object in turn. Markers can't flood between objects, so this gives the same segments as
+# watershedding the whole image at once, except that ties between neighbouring markers may be broken the other way.
+def objectwatershed(distance, markers, binary):
+    objects = ndi.label(binary)[0]
+    labels = np.zeros(binary.shape, markers.dtype)
+    for label, box in enumerate(ndi.find_objects(objects), 1):
+        inside = objects[box] == label
+        labels[box][inside] = watershed(-distance[box], markers[box] * inside, mask=inside)[inside]
+    return labels
+
+
+# Clear segments touching the image borders, in place.
+def clearedges(labels):
+    edges = np.unique(np.concatenate((labels[0], labels[-1], labels[:, 0], labels[:, -1])))
+    labels[np.isin(labels, edges[edges > 0])] = 0
+    return labels
+
+
+# Segment a large image in overlapping tiles, working on several at once. Each tile is segmented along with a margin
+# (halo) of the pixels around it and only its own pixels are kept, so segments near its sides aren't cut short.
+# Segments crossing from one tile into the next are then joined up, and those touching the sides of the whole image
+# are cleared. With a halo wider than the largest objects plus the smoothing radius this finds the same segments as
+# the whole image at once, apart from ties on the boundaries between touching segments. Automatic thresholds are
+# pooled from samples of every tile (see SegSettings), so can differ slightly. Returns the label image and threshold.
+def tiledsegment(imagearray, settings, imgtype, depth, profiler=None):
+    tiles = maketiles(imagearray.shape, settings.tilesize, settings.tilehalo)
+    threshold = settings.threshold
+    with ThreadPoolExecutor(min(len(tiles), os.cpu_count() or 1)) as executor:
+        if settings.method != "Manual":
+            with stage(profiler, imgtype + ' threshold'):
+                pooled = list(executor.map(lambda index: tilevalues(imagearray, tiles[index], settings, imgtype,
+                                                                    depth[0], index), range(len(tiles))))
+                threshold = pooledthreshold([values for values, scale in pooled], settings.method, imgtype, depth,
+                                            pooled[0][1])
+                del pooled
+        with stage(profiler, imgtype + ' tiles'):
+            results = executor.map(lambda tile: segmenttile(imagearray, tile, threshold, settings), tiles)
+            labels = clearedges(stitchtiles(imagearray.shape, tiles, results))
+    return labels, threshold
+
+
+# Split an image into tiles. Each is a pair of slice tuples, for the tile itself and for the tile with its halo.
+def maketiles(shape, tilesize, halo):
+    tiles = []
+    for top in range(0, shape[0], tilesize):
+        for left in range(0, shape[1], tilesize):
+            core = (slice(top, min(top + tilesize, shape[0])), slice(left, min(left + tilesize, shape[1])))
+            window = tuple(slice(max(side.start - halo, 0), min(side.stop + halo, size))
+                           for side, size in zip(core, shape))
+            tiles.append((core, window))
+    return tiles
+
+
+# Sample threshold values from the tile at index. Peak filters look at the tile's halo too, so tiles match up at the
+# seams. Returns the values and their scale, see thresholdvalues.
+def tilevalues(imagearray, tile, settings, imgtype, multiplier, index):
+    core, window = tile
+    values, scale = thresholdvalues(imagearray[window], imgtype, multiplier, settings.prefilter)
+    step = (window[0].stop - window[0].start) // values.shape[0]  # Downsampled peaks cover blocks of pixels.
+    inner = tuple(slice((c.start - w.start) // step, (c.stop - w.start) // step) for c, w in zip(core, window))
+    return samplevalues(values[inner], settings.samples, np.random.RandomState(index)), scale
+
+
+# Segment one tile with its halo. Returns the labels for the tile plus a ring one pixel wide around it (which is
+# compared with its neighbours when stitching) and the position in the whole image at which each segment's marker
+# starts, to number segments in the same order as segmenting the whole image would.
+def segmenttile(imagearray, tile, threshold, settings):
+    core, window = tile
+    binary, distance = finddistance(imagearray[window], threshold, settings.lowmemory)
+    markers = findmarkers(distance, settings.smoothing)
+    labels = floodobjects(binary, distance, markers)
+    del binary, distance
+    numbers, first = np.unique(markers, return_index=True)  # Markers are numbered in order, with no gaps.
+    rows, cols = np.unravel_index(first, markers.shape)
+    anchors = (rows + window[0].start).astype(np.int64) * imagearray.shape[1] + cols + window[1].start
+    keep = tuple(slice(max(c.start - 1, w.start) - w.start, min(c.stop + 1, w.stop) - w.start)
+                 for c, w in zip(core, window))
+    return labels[keep].copy(), anchors
+
+
+# Join tiles' labels into one label image, taking results from segmenttile as they arrive. Each pixel takes its label
+# from the tile it belongs to, and a segment which crosses into a neighbouring tile is merged with the segment that
+# tile has there if they mostly agree on the pixels just across the seam. Each neighbouring tile is judged
+# separately, as a segment crossing a corner reaches into as many as three of them.
+def stitchtiles(shape, tiles, results):
+    stitched = np.zeros(shape, np.int32)
+    rings = []
+    present = []
+    allanchors = [[-1]]  # Background
+    tileof = [[-1]]  # Which tile each segment came from.
+    offset = 0
+    for (core, window), (labels, anchors) in zip(tiles, results):
+        kept = tuple(slice(max(c.start - 1, 0), min(c.stop + 1, size)) for c, size in zip(core, shape))
+        inner = tuple(slice(c.start - k.start, c.stop - k.start) for c, k in zip(core, kept))
+        labels[labels > 0] += offset  # Number segments from all tiles together.
+        stitched[core] = labels[inner]
+        present.append(np.unique(labels[inner]))
+        ring = labels > 0
+        ring[inner] = False
+        rows, cols = np.nonzero(ring)
+        rings.append((rows + kept[0].start, cols + kept[1].start, labels[ring]))
+        allanchors.append(anchors[1:])
+        tileof.append(np.full(len(anchors) - 1, len(tileof) - 1))
+        offset += len(anchors) - 1
+    numlabels = offset + 1
+    pairs = []
+    for rows, cols, labels in rings:
+        neighbours = stitched[rows, cols]
+        found = neighbours > 0
+        pairs.append(np.stack((labels[found], neighbours[found]), axis=1).astype(np.int64))
+    pairs = np.concatenate(pairs)
+    parents = np.arange(numlabels)
+    if len(pairs):
+        pairs, counts = np.unique(pairs, axis=0, return_counts=True)
+        tileof = np.concatenate(tileof)
+        seams = np.unique(np.stack((pairs[:, 0], tileof[pairs[:, 1]]), axis=1), axis=0, return_inverse=True)[1]
+        totals = np.bincount(seams.ravel(), weights=counts)
+        for (label, neighbour), count, seam in zip(pairs, counts, seams.ravel()):
+            if count * 2 > totals[seam]:  # Most of the segment's ring in that tile is one of its segments.
+                label, neighbour = findroot(parents, label), findroot(parents, neighbour)
+                parents[max(label, neighbour)] = min(label, neighbour)
+    roots = np.array([findroot(parents, label) for label in range(numlabels)])
+    # Order joined segments by their earliest marker, which is how segmenting the whole image numbers them.
+    earliest = np.full(numlabels, np.iinfo(np.int64).max)
+    np.minimum.at(earliest, roots, np.concatenate(allanchors))
+    present = np.unique(roots[np.concatenate(present)])
+    present = present[present > 0]
+    numbering = np.zeros(numlabels, np.int32)
+    numbering[present[np.argsort(earliest[present], kind='stable')]] = np.arange(1, len(present) + 1)
+    numbering = numbering[roots]
+    for core, window in tiles:  # A tile at a time, to keep working space small.
+        stitched[core] = numbering[stitched[core]]
+    return stitched
+
 
+def findroot(parents, label):
+    while parents[label] != label:
+        parents[label] = parents[parents[label]]
+        label = parents[label]
+    return label
 
-def makesubsets(roilabel, regionseg, regioncentroids, spotcentroids, origregion, origspot):
-    labellist = np.ndarray.tolist(np.unique(regionseg))
-    # Need to find index of correct label
-    indexid = labellist.index(roilabel)
-    a, b, c, d = regioncentroids[indexid - 1][2]
+
+class SegmentationCache:
+    # Least recently used store of segmentations, so the viewer's overlays and an analysis run in the same session
+    # don't segment the same plane with the same settings twice. Entries are dropped once the label images held
+    # exceed maxbytes. Safe to share between threads.
+    def __init__(self, maxbytes=256 * 2 ** 20):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[0].nbytes
+            self.entries[key] = value
+            self.size += value[0].nbytes
+            self.trim()
+
+    # Change the memory cap, discarding entries if needed.
+    def resize(self, maxbytes):
+        with self.lock:
+            self.maxbytes = maxbytes
+            self.trim()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def trim(self):
+        while self.entries and self.size > self.maxbytes:
+            key, value = self.entries.popitem(last=False)
+            self.size -= value[0].nbytes
+
+
+# Time a stage of the analysis if a profiler is in use.
+def stage(profiler, name):
+    return nostage if profiler is None else profiler.stage(name)
+
+
+class StageProfiler:
+    # Records the wall time and, optionally, peak memory allocated during each stage of the analysis, per plane.
+    # Stages can be nested, e.g. segmentation includes thresholding, so their times overlap. Memory is tracked with
+    # tracemalloc, which slows the run down; it is shared by the whole process, so only profile memory use in one
+    # run at a time.
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.planes = []
+        self.current = None
+        self.openstages = []  # [starting memory, peak memory] for each stage in progress.
+        self.startedtracing = False
+
+    def start(self):
+        self.planes = []
+        self.current = None
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.startedtracing = True
+
+    def stop(self):
+        if self.startedtracing:
+            tracemalloc.stop()
+            self.startedtracing = False
+
+    def beginplane(self, imgfile, planeid):
+        self.current = {'file': imgfile, 'plane': planeid + 1, 'stages': {}}
+        self.planes.append(self.current)
+
+    @contextmanager
+    def stage(self, name):
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            for openstage in self.openstages:  # Peaks are reset below, so pass on the peak so far.
+                openstage[1] = max(openstage[1], peak)
+            if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+, otherwise peaks are since tracing started.
+                tracemalloc.reset_peak()
+            self.openstages.append([current, current])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peakbytes = 0
+            if tracing:
+                startmemory, peak = self.openstages.pop()
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                if self.openstages:
+                    self.openstages[-1][1] = max(self.openstages[-1][1], peak)
+                peakbytes = peak - startmemory
+            self.record(name, elapsed, peakbytes)
+
+    def record(self, name, seconds, peakbytes):
+        if self.current is None:
+            self.beginplane("", -1)
+        entry = self.current['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0, 'peak_bytes': 0})
+        entry['seconds'] += seconds
+        entry['calls'] += 1
+        entry['peak_bytes'] = max(entry['peak_bytes'], peakbytes)
+
+    # Most memory allocated during any stage of the current plane, in bytes.
+    def planepeak(self):
+        if self.current is None:
+            return 0
+        return max((entry['peak_bytes'] for entry in self.current['stages'].values()), default=0)
+
+    # Totals for each stage over all planes.
+    def summary(self):
+        totals = {}
+        for plane in self.planes:
+            for name, entry in plane['stages'].items():
+                total = totals.setdefault(name, {'seconds': 0.0, 'calls': 0, 'planes': 0, 'peak_bytes': 0})
+                total['seconds'] += entry['seconds']
+                total['calls'] += entry['calls']
+                total['planes'] += 1
+                total['peak_bytes'] = max(total['peak_bytes'], entry['peak_bytes'])
+        return totals
+
+    # Log a summary of the run and save the full report next to the run's output file.
+    def report(self, run):
+        totals = self.summary()
+        if not totals:
+            return
+        run.logevent(f"Stage timings over {len(self.planes)} planes:")
+        for name, total in totals.items():
+            text = f"{name}: {total['seconds']:.2f}s total, {total['seconds'] / total['planes']:.3f}s per plane"
+            if self.memory:
+                text += f", peak {total['peak_bytes'] / 2 ** 20:.1f}MB"
+            run.logevent(text)
+        if run.writer is None:
+            return
+        savetgt = os.path.splitext(run.writer.path)[0] + '_profile.json'
+        try:
+            with open(savetgt, 'w') as reportfile:
+                json.dump({'memory': self.memory, 'summary': totals, 'planes': self.planes}, reportfile, indent=1)
+            run.logevent("Stage report saved to " + savetgt)
+        except OSError:
+            run.logevent("OSError, failed to write to " + savetgt)
+
+
+# Index a plane's cells by label: bounding box slices, centroid details and the spots which fall inside each cell.
+# Spots are assigned by reading the label image at each spot centroid.
+def indexcells(regionseg, regionlabels, regioncentroids, spotcentroids):
+    cellspots = {label: [] for label in regionlabels}
+    if len(spotcentroids) > 0:
+        spotcoords = np.array([spot[0] for spot in spotcentroids])
+        owners = regionseg[spotcoords[:, 0], spotcoords[:, 1]]
+        for spot, owner in zip(spotcentroids, owners):
+            if owner in cellspots:
+                cellspots[owner].append(spot)
+    cellindex = {label: (centroid[2], centroid, cellspots[label]) for label, centroid in
+                 zip(regionlabels, regioncentroids)}
+    return cellindex
+
+
+def makesubsets(roilabel, cellindex, regionseg, origregion, origspot):
+    bbox, regioncentroid, cellspots = cellindex[roilabel]
     # Add a border just to ease visualisation
-    a -= 1
-    b -= 1
-    c += 1
-    d += 1
-    roiregion = regionseg.copy()[a:c, b:d]
-    roiregionraw = origregion.copy()[a:c, b:d]
-    roispotraw = origspot.copy()[a:c, b:d]
-    # Generate filtespot mask
-    regioncentroid = [regioncentroids[indexid - 1][0], regioncentroids[indexid - 1][1]]
+    a = bbox[0].start - 1
+    b = bbox[1].start - 1
+    c = bbox[0].stop + 1
+    d = bbox[1].stop + 1
+    roiregionraw = origregion[a:c, b:d].copy()
+    roispotraw = origspot[a:c, b:d].copy()
     # Remove other regions from the image
-    roiregion = np.where(roiregion == roilabel, 65000, 0)
-    roiregionlist = np.transpose(np.nonzero(roiregion))
-    # Create list of points within region
-    roiregionlist = np.ndarray.tolist(roiregionlist)
+    roiregion = np.where(regionseg[a:c, b:d] == roilabel, 65000, 0)
     roiregioncentroid = [[regioncentroid[0][0] - a, regioncentroid[0][1] - b], regioncentroid[1]]
-    # Filter spot centroid list for tgt region & correct for subsetting.
-    roispotcentroids = [([spot[0][0] - a, spot[0][1] - b], spot[1], spot[2], spot[3]) for spot in spotcentroids if
-                        (c > spot[0][0] > a) and (d > spot[0][1] > b)]
-    # Check the centroids are within the nuclei
-    roispotcentroids = [spot for spot in roispotcentroids if spot[0] in roiregionlist]
+    # Correct the cell's spot centroids for subsetting.
+    roispotcentroids = [([spot[0][0] - a, spot[0][1] - b], spot[1], spot[2], spot[3]) for spot in cellspots]
     return roiregion, roiregioncentroid, roispotcentroids, roiregionraw, roispotraw
 
 
-# Get a list of coordinates in the perimeter.
+# Get an array of coordinates in the perimeter.
 def find_perim(roiregion):
     edges = find_boundaries(roiregion)
     perim = np.transpose(np.nonzero(edges))
-    perim = np.ndarray.tolist(perim)
     return perim
 
 
-# Returns list of coordinates in the line which intersects centroid and spot.
-def get_line_points(center, spot, inputimage):
-    maxhor = inputimage.shape[1]
-    maxver = inputimage.shape[0]
-    if center[0] == spot[0]:  # No need to do maths if line is perfectly horizontal/vertical.
-        linepoints = [[center[0], i] for i in range(maxhor)]
-    elif center[1] == spot[1]:
-        linepoints = [[i, center[1]] for i in range(maxver)]
-    else:  # Use algebra to find the equation of a line through the points.
-        points = [center, spot]
-        xcoords, ycoords = zip(*points)
-        eqinput = np.vstack([xcoords, np.ones(len(xcoords))]).T
-        if os.name == 'nt':
-            m, g = np.linalg.lstsq(eqinput, ycoords, rcond=None)[0]
-        else:
-            m, g = np.linalg.lstsq(eqinput, ycoords)[0]
-        ver2 = (maxhor - g) / m  # Maximum vertical
-        hor2 = (m * maxver) + g  # Maximum horizontal
-        ver1 = (0 - g) / m  # Horizontal = 0
-        hor1 = g  # Vertical = 0
-        plotpoints = []
-        # Select coordinates where lines would intersect with the borders of the image.
-        if 0 < ver1 < maxver:
-            plotpoints += [int(ver1), 0]
-        if 0 < hor1 < maxhor:
-            plotpoints += [0, int(hor1)]
-        if 0 < ver2 < maxver:
-            plotpoints += [int(ver2), maxhor]
-        if 0 < hor2 < maxhor:
-            plotpoints += [maxver, int(hor2)]
-        # Plotpoints should now always contain 2 coordinates.
-        # Future: Test for error when perfectly aligned e.g. (0,0) --> (10,10)
-        draw_line = line(plotpoints[0], plotpoints[1], plotpoints[2], plotpoints[3])
-        linepoints = np.transpose(draw_line)
-        linepoints = np.ndarray.tolist(linepoints)
-    return linepoints
+# Build a lookup table of perimeter pixels sorted by their angle around the region centroid.
+# The table is padded by one full turn so angular windows never need to wrap around.
+def polar_perim(perim, center):
+    deltas = perim - np.asarray(center)
+    angles = np.arctan2(deltas[:, 0], deltas[:, 1])
+    radii = np.hypot(deltas[:, 0], deltas[:, 1])
+    order = np.argsort(angles)
+    angles = angles[order]
+    paddedangles = np.concatenate((angles, angles + 2 * np.pi))
+    minradius = radii.min() if len(radii) > 0 else 0
+    return paddedangles, perim[order], minradius
 
 
 # Finding the correct perimeter spot.
-def find_perim_intersect(perim, linepoints, intspotspot):
-    # Find all perimeter pixels touched by the line
-    both = [x for x in perim if x in linepoints]
-    tgtpoint = tuple(intspotspot)  # Get tuple of spot coordinate
-    tgtlist = [tuple(item) for item in both]
-    tgtlist = np.asarray(tgtlist)
-    deltas = tgtlist - tgtpoint
+# Equivalent to rasterising a line through the centroid and spot and picking the touched perimeter pixel closest to
+# the spot, but only pixels in the matching angular window of the polar table are tested. A pixel counts as touched
+# when it lies within half a pixel of the ideal line along the line's minor axis, as with Bresenham rasterisation.
+# Results agree with the old border-to-border rasterisation to within 1 pixel of perimeter position. Distances can
+# differ by up to ~1 pixel (a few percent migration) where the old line endpoints were rounded off the true line.
+def find_perim_intersect(polarperim, center, spot):
+    paddedangles, perim, minradius = polarperim
+    numpoints = len(perim)
+    direction = np.asarray(spot) - np.asarray(center)
+    if not direction.any():  # Spot on the centroid, measure horizontally as the line would.
+        direction = np.array([0, 1])
+    theta = np.arctan2(direction[0], direction[1])
+    # Widest angle at which a pixel can still be within half a pixel of the line.
+    if minradius > 0.5:
+        window = np.arcsin(0.5 / minradius)
+    else:
+        window = np.pi
+    candidates = []
+    for target in (theta, theta + np.pi):  # The line passes through the centroid, so check both directions.
+        lowest = (target - window + np.pi) % (2 * np.pi) - np.pi
+        first = np.searchsorted(paddedangles, lowest)
+        last = np.searchsorted(paddedangles, lowest + 2 * window, side='right')
+        candidates.append(np.arange(first, min(last, first + numpoints)) % numpoints)
+    candidates = np.unique(np.concatenate(candidates))
+    if len(candidates) == 0:
+        candidates = np.arange(numpoints)
+    tgtlist = perim[candidates]
+    offsets = tgtlist - np.asarray(center)
+    # Distance from the line along its minor axis.
+    deviation = np.abs(offsets[:, 0] * direction[1] - offsets[:, 1] * direction[0]) / np.abs(direction).max()
+    touched = deviation <= 0.5
+    if touched.any():
+        tgtlist = tgtlist[touched]
+    else:  # Thin diagonal perimeters can be skipped by the line, fall back to the nearest pixels to it.
+        tgtlist = tgtlist[deviation == deviation.min()]
+    deltas = tgtlist - np.asarray(spot)
     # Calculate how far each pixel is from the spot.
     dist = np.einsum('ij,ij->i', deltas, deltas)
     # Get ID of the perimeter pixel closest to the spot and choose that point.
@@ -198,183 +863,1012 @@ def gennumbers(centpoint, perimpoint, tgtpoint):
 
 
 # Cycle through each cell in an image.
-def cyclecells(im, im2, region_settings, spot_settings, wantpreview, one_per_cell, stopper, multiplier):
-    global indexnum, cellnum, currplane, imgfile
+# Sources identify the (file, plane) of each image for the run's segmentation cache.
+def cyclecells(run, im, im2, region_settings, spot_settings, wantpreview, one_per_cell, stopper, multiplier,
+               sources=(None, None)):
+    profiler = run.profiler
+    if profiler is not None:
+        profiler.beginplane(run.imgfile, run.currplane)
     # Fetch segmentations for each image.
-    regionseg, regionproperties, regionlabels = getseg(im, region_settings, 'region', False)
-    spotseg, spotproperties, spotlabels = getseg(im2, spot_settings, 'spot', False)
-    # Isolate stats of interest from region properties.
-    regioncentroids = [((int(item.centroid[0]), int(item.centroid[1])), item.area, item.bbox) for item in
-                       regionproperties]
-    spotcentroids = [((int(item.weighted_centroid[0]), int(item.weighted_centroid[1])), item.area, item.mean_intensity,
-                      (item.area * item.mean_intensity)) for item in spotproperties]
+    with stage(profiler, 'segmentation'):
+        regionseg, regionmeasures, regionlabels = getseg(im, region_settings, 'region', False,
+                                                         run.bit_depth_update(im), run.segcache, sources[0],
+                                                         profiler=profiler)
+        spotseg, spotmeasures, spotlabels = getseg(im2, spot_settings, 'spot', False, run.bit_depth_update(im2),
+                                                   run.segcache, sources[1], profiler=profiler)
     # Detect and remove spot segmentations which don't make sense.
     maxarea = 500
-    spotcentroidsonly = [spot_data[1] for spot_data in spotcentroids]
-    numcentroids = len(spotcentroidsonly)
+    spotareas = spotmeasures.area
     # Abandon analysis if there are too many spots above threshold size or any outrageously large ones.
-    if len([x for x in spotcentroidsonly if x >= maxarea]) >= 5 or len(
-            [x for x in spotcentroidsonly if x >= 10000]) >= 1:
-        logevent("Spot segmentation failed, skipping image")
+    if np.count_nonzero(spotareas >= maxarea) >= 5 or np.count_nonzero(spotareas >= 10000) >= 1:
+        run.logevent("Spot segmentation failed, skipping image")
         return
     # Otherwise remove them as noise and let the user know.
-    spotcentroids = [spot_data for spot_data in spotcentroids if spot_data[1] < maxarea]  # Remove overly large spots
-    if numcentroids > len(spotcentroids):
-        logevent("Plane " + str("%02d" % (currplane + 1)) + ": Removed " + str(
-            numcentroids - len(spotcentroids)) + " objects that were too large")
+    keep = spotareas < maxarea
+    if not keep.all():
+        run.logevent("Plane " + str("%02d" % (run.currplane + 1)) + ": Removed " + str(
+            len(keep) - np.count_nonzero(keep)) + " objects that were too large")
+    # Gather the stats of interest for each object.
+    with stage(profiler, 'object properties'):
+        rows, cols = (coords.astype(int).tolist() for coords in regionmeasures.centroid)
+        regioncentroids = list(zip(zip(rows, cols), regionmeasures.area.tolist(), regionmeasures.bbox))
+        rows, cols = (coords[keep].astype(int).tolist() for coords in spotmeasures.weightedcentroid)
+        areas, means = spotareas[keep].tolist(), spotmeasures.meanintensity[keep].tolist()
+        spotcentroids = [(spot, area, mean, area * mean) for spot, area, mean in zip(zip(rows, cols), areas, means)]
+    with stage(profiler, 'cell indexing'):
+        cellindex = indexcells(regionseg, regionlabels, regioncentroids, spotcentroids)
+    run.update_progress("plane", len(regionlabels))
+    with stage(profiler, 'cell measurement'):
+        spots = measurecells(run, im, im2, regionseg, regionlabels, cellindex, wantpreview, one_per_cell, stopper,
+                             multiplier)
+    if spots is None:
+        run.update_progress('finished', 0)
+        return
+    peak = ""
+    if profiler is not None and profiler.memory:
+        peak = " Peak memory " + str("%0.1f" % (profiler.planepeak() / 2 ** 20)) + "MB."
+    run.logevent("Plane " + str("%02d" % (run.currplane + 1)) + ": Analysed " + str(spots) + " spots in " + str(
+        len(regionlabels)) + " cells." + peak)
+    return
+
+
+# Measure every spot in each cell of a plane, using the run's measuremode. Returns the number of spots measured, or
+# None if the run was stopped.
+def measurecells(run, im, im2, regionseg, regionlabels, cellindex, wantpreview, one_per_cell, stopper, multiplier):
     spots = 0
-    update_progress("plane", len(regionlabels))
     for cell in regionlabels:  # Iterate through each cell label, subset the image to just that cell.
         if stopper.is_set():
-            update_progress("cell", 0)
-            roiregion, regioncent, spotcents, braw, rraw = makesubsets(cell, regionseg, regioncentroids, spotcentroids,
-                                                                       im, im2)
-            perim = find_perim(roiregion)  # Get perimeter of the region.
-            if len(spotcents) > 0:
-                cellnum += 1
+            run.update_progress("cell", 0)
+            numspots = len(cellindex[cell][2])
+            if numspots > 0:
+                run.cellnum += 1
             # Analyse the spots, but when single spot mode is on only analyse if there's a single spot.
-            if (len(spotcents) == 1 and one_per_cell is True) or one_per_cell is False:
+            if numspots > 0 and ((numspots == 1 and one_per_cell is True) or one_per_cell is False):
+                roiregion, regioncent, spotcents, braw, rraw = makesubsets(cell, cellindex, regionseg, im, im2)
+                if run.measuremode == 'distance':
+                    spots += measuredistances(run, roiregion, regioncent, spotcents, braw, rraw, wantpreview,
+                                              multiplier)
+                    continue
+                perim = find_perim(roiregion)  # Get perimeter of the region.
+                polarperim = polar_perim(perim, regioncent[0])  # Index it by angle once for all of the cell's spots.
                 for spot in spotcents:
-                    linepoints = get_line_points(regioncent[0], spot[0], roiregion)
-                    perimpoint = find_perim_intersect(perim, linepoints, spot[0])
+                    perimpoint = find_perim_intersect(polarperim, regioncent[0], spot[0])
                     dist, spotcenter, spotperim, pctmig = gennumbers(regioncent[0], perimpoint, spot[0])
                     # Send data for writing to the log.
-                    datawriter(imgfile, (
+                    run.datawriter((
                         regioncent[1], spot[1], spot[2], spot[3], dist, spotcenter, spotperim, ('%0.2f' % pctmig)))
                     spots += 1
-                    indexnum += 1
+                    run.indexnum += 1
                     if wantpreview is True:  # Generate result images if the user has asked for them.
-                        betterpreview(braw, rraw, regioncent[0], perimpoint, spot[0], indexnum, multiplier)
+                        with stage(run.profiler, 'result images'):
+                            run.betterpreview(braw, rraw, regioncent[0], perimpoint, spot[0], run.indexnum,
+                                              multiplier)
         else:
-            update_progress('finished', 0)
-            return
-    logevent("Plane " + str("%02d" % (currplane + 1)) + ": Analysed " + str(spots) + " spots in " + str(
-        len(regionlabels)) + " cells.")
-    return
+            return None
+    return spots
 
 
-# Cycle through image planes.
-def cycleplanes(regionimg, spotimg, region_settings, spot_settings, output_params, one_per_cell, stopper):
-    global currplane
-    wantpreview, one_plane, one_plane_id = output_params
+# Measure a cell's spots from a distance transform of the cell, giving every pixel's distance to the nearest pixel
+# outside it, rather than by tracing lines to its perimeter. Results go in the usual columns: the radius of the
+# largest circle which fits in the cell (its greatest distance) in place of the centroid to perimeter distance, and
+# each spot's distance in place of the spot to perimeter distance. Percent migration is the second as a percentage
+# of the first. Takes a cell's subsets from makesubsets, returns the number of spots measured.
+def measuredistances(run, roiregion, regioncent, spotcents, braw, rraw, wantpreview, multiplier):
+    if wantpreview is True:
+        distances, nearest = ndi.distance_transform_edt(roiregion, return_indices=True)
+    else:
+        distances = ndi.distance_transform_edt(roiregion)
+    radius = float(distances.max())
+    for spot in spotcents:
+        row, col = spot[0]
+        spotperim = float(distances[row, col])
+        spotcenter = hypot(row - regioncent[0][0], col - regioncent[0][1])
+        pctmig = spotperim / radius * 100 if radius > 0 else 0
+        run.datawriter((regioncent[1], spot[1], spot[2], spot[3], radius, spotperim, spotcenter, ('%0.2f' % pctmig)))
+        run.indexnum += 1
+        if wantpreview is True:  # The line drawn is the one measured, from the spot to the nearest pixel outside.
+            with stage(run.profiler, 'result images'):
+                perimpoint = (int(nearest[0, row, col]), int(nearest[1, row, col]))
+                run.betterpreview(braw, rraw, spot[0], perimpoint, spot[0], run.indexnum, multiplier)
+    return len(spotcents)
+
+
+# Check a pair of image stacks can be analysed and choose which planes to use.
+# Returns the number of planes in the stack (None if unreadable), a list of plane IDs and a message for the log.
+def getplanes(regionimg, spotimg, output_params):
+    wantpreview, one_plane, one_plane_id, focusplanes, projection = output_params
     try:
-        img = Image.open(regionimg)
-        img2 = Image.open(spotimg)
+        with TiffStack(regionimg) as img, TiffStack(spotimg) as img2:
+            if img.mode not in validmodes:
+                return 0, [], "Invalid region file type, skipping"
+            elif img2.mode not in validmodes:
+                return 0, [], "Invalid spot file type, skipping"
+            numframes = img.n_frames
+            if focusplanes and not one_plane and numframes > focusplanes:
+                # Only analyse the sharpest planes of the region channel that the spot stack also has, useful for
+                # z-stacks.
+                scores = np.array([focusscore(img.plane(i)) for i in range(min(numframes, img2.n_frames))])
+                planes = sorted(np.argsort(-scores, kind='stable')[:focusplanes].tolist())
+                return numframes, planes, "Sharpest planes: " + ", ".join(str(i + 1) for i in planes)
     except OSError:
-        logevent("Invalid image format, skipping file.")
+        return None, [], "Invalid image format, skipping file."
+    if one_plane:  # Only analyse single plane, useful for z-stacks.
+        if numframes > one_plane_id:
+            return numframes, [one_plane_id], None
+        return numframes, [], "Image does not have " + str(one_plane_id + 1) + " planes, skipping."
+    return numframes, list(range(numframes)), None  # Analyse all planes, useful for field stacks.
+
+
+# How sharply focused a plane is, as the variance of its Laplacian. The plane is shrunk to focussize by averaging
+# blocks of pixels first, which is much quicker and less sensitive to noise.
+def focusscore(imgarray):
+    factor = max(1, min(ceil(max(imgarray.shape) / focussize), *imgarray.shape))
+    rows, cols = imgarray.shape[0] // factor, imgarray.shape[1] // factor
+    small = imgarray[:rows * factor, :cols * factor].reshape(rows, factor, cols, factor).mean(axis=(1, 3),
+                                                                                            dtype=np.float32)
+    return float(ndi.laplace(small).var())
+
+
+# Group the planes chosen from a stack into the images to analyse, as {plane ID: IDs of the planes to read}. Each
+# plane is analysed on its own, unless a projection is set and there are several, in which case they are projected
+# onto one image numbered as the first plane of the stack.
+def planegroups(planes, projection):
+    if projection and len(planes) > 1:
+        return {0: planes}
+    return {planeid: [planeid] for planeid in planes}
+
+
+# Read a plane from a stack, or project several onto one image using one of projections, reading a plane at a time.
+# Mean projections are rounded to the type of the planes. Sums are 16-bit, saturating at the brightest value.
+def projectplanes(stack, planeids, projection):
+    first = stack.plane(planeids[0])
+    if len(planeids) == 1:
+        return first
+    dtype = np.dtype(first.dtype.name)  # Native byte order.
+    total = first.astype(dtype if projection == 'max' else np.uint32)
+    for planeid in planeids[1:]:
+        if projection == 'max':
+            np.maximum(total, stack.plane(planeid), out=total)
+        else:
+            total += stack.plane(planeid)
+    if projection == 'mean':
+        total += len(planeids) // 2
+        total //= len(planeids)
+        return total.astype(dtype)
+    elif projection == 'sum':
+        np.minimum(total, np.iinfo(np.uint16).max, out=total)
+        return total.astype(np.uint16)
+    return total
+
+
+# Cycle through image planes.
+def cycleplanes(run, regionimg, spotimg, region_settings, spot_settings, output_params, one_per_cell, stopper):
+    wantpreview, projection = output_params[0], output_params[4]
+    numframes, planes, message = getplanes(regionimg, spotimg, output_params)
+    if numframes is None:
+        run.logevent(message)
         return
-    if img.mode != 'I;8' and img.mode != 'I;16' and img.mode != 'L':
-        logevent("Invalid region file type, skipping")
-        update_progress("file", 0)
-    elif img2.mode != 'I;8' and img2.mode != 'I;16' and img2.mode != 'L':
-        logevent("Invalid spot file type, skipping")
-        update_progress("file", 0)
-    else:
-        numframes = img.n_frames
-        update_progress("file", numframes)
-        if one_plane:  # Only analyse single plane, useful for z-stacks.
-            if numframes >= one_plane_id:
-                if stopper.is_set():
-                    img.seek(one_plane_id)
-                    img2.seek(one_plane_id)
-                    im = np.array(img)
-                    im2 = np.array(img2)
-                    multiplier, absolute_min = bit_depth_update(im)
-                    currplane = one_plane_id
-                    cyclecells(im, im2, region_settings, spot_settings, wantpreview, one_per_cell, stopper, multiplier)
-                else:
-                    update_progress('finished', 0)
-                    return
+    groups = planegroups(planes, projection)
+    run.update_progress("file", len(groups) if projection else numframes)
+    if message:
+        run.logevent(message)
+    remaining = [i for i in groups if not run.isdone(regionimg, i)]
+    if len(remaining) < len(groups):
+        run.logevent(f"Skipping {len(groups) - len(remaining)} planes completed earlier")
+    if not remaining:
+        return
+    region_settings, spot_settings, notes = sharedthresholds(run, [(regionimg, spotimg, planes)], region_settings,
+                                                             spot_settings, 'stack', stopper, projection)
+    for note in notes:
+        run.logevent(note)
+    with TiffStack(regionimg) as img, TiffStack(spotimg) as img2:
+        for i in remaining:
+            if stopper.is_set():
+                im = projectplanes(img, groups[i], projection)
+                im2 = projectplanes(img2, groups[i], projection)
+                if len(groups[i]) > 1:
+                    run.logevent(f"Analysing {projection} projection of {len(groups[i])} planes")
+                multiplier, absolute_min = run.bit_depth_update(im)
+                run.currplane = i
+                source = groups[i][0] if len(groups[i]) == 1 else (projection,) + tuple(groups[i])  # For the cache.
+                cyclecells(run, im, im2, region_settings, spot_settings, wantpreview, one_per_cell, stopper,
+                           multiplier, ((regionimg, source), (spotimg, source)))
+                run.flushdata()
+                if stopper.is_set():  # Only once the whole plane is done.
+                    run.checkpoint()
             else:
-                logevent("Image does not have " + str(one_plane_id + 1) + " planes, skipping.")
-        else:  # Analyse all planes, useful for field stacks.
-            for i in range(numframes):
-                if stopper.is_set():
-                    img.seek(i)
-                    img2.seek(i)
-                    im = np.array(img)
-                    im2 = np.array(img2)
-                    multiplier, absolute_min = bit_depth_update(im)
-                    currplane = i
-                    cyclecells(im, im2, region_settings, spot_settings, wantpreview, one_per_cell, stopper, multiplier)
-                else:
-                    update_progress('finished', 0)
-                    return
+                run.update_progress('finished', 0)
+                return
 
 
 # Cycle through files
-def cyclefiles(regioninput, spotinput, region_settings, spot_settings, output_params, prevdir, one_per_cell,
-               stopper):
-    global savedir, previewdir, imgfile
-    previewdir = prevdir
-    update_progress("starting", len(regioninput))
-    for i in range(len(regioninput)):
-        logevent(f"Analysing {regioninput[i]}")
-        imgfile = regioninput[i]
-        if stopper.is_set():
-            cycleplanes(regioninput[i], spotinput[i], region_settings, spot_settings, output_params, one_per_cell,
-                        stopper)
+def cyclefiles(run, regioninput, spotinput, region_settings, spot_settings, output_params, one_per_cell, stopper,
+               workers=1):
+    run.update_progress("starting", len(regioninput))
+    with running(run, region_settings, spot_settings, output_params, one_per_cell):
+        if analysefiles(run, regioninput, spotinput, region_settings, spot_settings, output_params, one_per_cell,
+                        stopper, workers):
+            run.update_progress("finished", 1)
         else:
-            update_progress('finished', 0)
-            return
-    update_progress("finished", 1)
+            run.update_progress('finished', 0)
+
 
+# Analyse each pair of files in turn. Returns False if the run was stopped.
+def analysefiles(run, regioninput, spotinput, region_settings, spot_settings, output_params, one_per_cell, stopper,
+                 workers=1):
+    if 'batch' in (SegSettings(*region_settings).scope, SegSettings(*spot_settings).scope):
+        run.logevent("Calculating thresholds for the batch")
+        pairs = [(regioninput[i], spotinput[i], getplanes(regioninput[i], spotinput[i], output_params)[1])
+                 for i in range(len(regioninput))]
+        region_settings, spot_settings, notes = sharedthresholds(run, pairs, region_settings, spot_settings,
+                                                                 'batch', stopper, output_params[4])
+        for note in notes:
+            run.logevent(note)
+    if workers > 1:
+        cyclefiles_parallel(run, regioninput, spotinput, region_settings, spot_settings, output_params,
+                            one_per_cell, stopper, workers)
+        return stopper.is_set()
+    for i in range(len(regioninput)):
+        run.logevent(f"Analysing {regioninput[i]}")
+        run.imgfile = regioninput[i]
+        if not stopper.is_set():
+            return False
+        cycleplanes(run, regioninput[i], spotinput[i], region_settings, spot_settings, output_params,
+                    one_per_cell, stopper)
+    return True
 
-# Writes headers in output file
-def headers(logfile):
-    global savedir
-    savedir = logfile
-    headings = ('File', 'Plane', 'Cell ID', 'Spot ID', 'Region Area', 'Spot Area', 'Spot Average Intensity',
-                'Spot Integrated Intensity', 'Perimeter -> Centroid', 'Perimeter -> Spot', 'Spot -> Centroid',
-                'Percent Migration')
 
+# Set up to analyse files with these settings, then write out everything collected when done, even if the run was
+# stopped early.
+@contextmanager
+def running(run, region_settings, spot_settings, output_params, one_per_cell):
+    # Results depend on these, so planes are only skipped when resuming with the same ones.
+    run.settingskey = repr((tuple(SegSettings(*region_settings)), tuple(SegSettings(*spot_settings)), one_per_cell,
+                            output_params[4], run.measuremode))
+    if run.profiler is not None:
+        run.profiler.start()
+    if output_params[0]:
+        run.previews = PreviewWriter(run.previewdir, run.previewlayout, run)
     try:
-        with open(savedir, 'w', newline="\n", encoding="utf-8") as f:
-            headerwriter = csvwriter(f)
-            headerwriter.writerow(headings)
-        f.close()
-    except AttributeError:
-        logevent("Directory appears to be invalid")
-    except PermissionError:
-        logevent("Unable to write to save file. Please check write permissions.")
-    except OSError:
-        logevent("OSError, failed to write to save file.")
+        yield
+    finally:
+        if run.writer is not None:
+            run.writer.finish()
+        if run.previews is not None:
+            run.previews.close()
+            run.previews = None
+        if run.profiler is not None:
+            run.profiler.stop()
+            run.profiler.report(run)
+
+
+# Analyse image pairs as they appear in a directory, e.g. while a microscope is still writing them, until the
+# stopper is cleared. Files are found as in genfilelist, and each region file is paired with the spot file which has
+# the same path apart from its keyword (see pairingkey). Pairs are analysed once neither file has changed for settle
+# seconds and both can be read in full, checking every interval seconds. Files which are already there when watching
+# starts are analysed first. Results are written out plane by plane. Batch thresholds cover the files picked up by
+# each check together.
+def watchfolder(run, tgtdirectory, subdirectories, regnkwd, spotkwd, mode, region_settings, spot_settings,
+                output_params, one_per_cell, stopper, workers=1, interval=5, settle=10):
+    run.logevent(f"Watching {tgtdirectory} for new images")
+    index = FileIndex()  # Only directories which have changed are listed again on each check.
+    changes = {}  # Path: (size, modification time, when first seen like that)
+    done = set()
+    with running(run, region_settings, spot_settings, output_params, one_per_cell):
+        while stopper.is_set():
+            regionfiles, spotfiles, regionshortnames, spotshortnames = genfilelist(
+                tgtdirectory, subdirectories, regnkwd, spotkwd, mode, index)
+            spotfiles = {pairingkey(spotfile, tgtdirectory, spotkwd, mode): spotfile for spotfile in spotfiles}
+            ready = [], []
+            for regionfile in regionfiles:
+                spotfile = spotfiles.get(pairingkey(regionfile, tgtdirectory, regnkwd, mode))
+                if regionfile in done or spotfile is None:
+                    continue
+                regionsettled = settled(regionfile, changes, settle)
+                if settled(spotfile, changes, settle) and regionsettled and complete(regionfile) and \
+                        complete(spotfile):
+                    ready[0].append(regionfile)
+                    ready[1].append(spotfile)
+                    done.add(regionfile)
+            if ready[0]:
+                run.update_progress("starting", len(ready[0]))
+                if not analysefiles(run, *ready, region_settings, spot_settings, output_params, one_per_cell,
+                                    stopper, workers):
+                    break
+            for tick in range(int(interval * 10)):
+                if not stopper.is_set():
+                    break
+                time.sleep(0.1)
+        run.update_progress("finished", 1)
+
+
+# What's left of a file's path once its keyword is removed, so that region and spot files can be paired up by name.
+# Separators left before the keyword are dropped too, so e.g. "cell_Blue.tif" and "cell_Red.tif" pair up with
+# keywords "Blue" and "_Red".
+def pairingkey(path, tgtdirectory, keyword, mode):
+    if mode == 0:
+        prefix, searched = os.path.split(path)
+    elif mode == 1:
+        prefix, searched = tgtdirectory, os.path.relpath(path, tgtdirectory)
+    else:
+        prefix, searched = "", path
+    before, after = searched.split(keyword, 1)
+    return os.path.join(prefix, before.rstrip("_- ") + after)
 
 
-# Write data to CSV file
-def datawriter(exportpath, exportdata):
-    global currplane
-    writeme = (exportpath, currplane + 1, cellnum, indexnum + 1) + exportdata
+# Whether a file has stayed the same size and age for settle seconds, recording what was seen in changes.
+def settled(path, changes, settle):
     try:
-        with open(savedir, 'a', newline="\n", encoding="utf-8") as f:
-            mainwriter = csvwriter(f)
-            mainwriter.writerow(writeme)
-        f.close()
-    except AttributeError:
-        logevent("Directory appears to be invalid")
-    except PermissionError:
-        logevent("Unable to write to save file. Please check write permissions.")
+        info = os.stat(path)
     except OSError:
-        logevent("OSError, failed to write to save file.")
+        return False
+    now = time.monotonic()
+    size, modified, since = changes.get(path, (None, None, now))
+    if (size, modified) != (info.st_size, info.st_mtime_ns):
+        changes[path] = (info.st_size, info.st_mtime_ns, now)
+        return settle <= 0
+    return now - since >= settle
+
+
+# Whether every plane of a stack can be read, in case it's still being written after a pause.
+def complete(path):
+    try:
+        with TiffStack(path) as stack:
+            stack.plane(stack.n_frames - 1)
+    except Exception:  # Partly written files can trip up PIL in many different ways.
+        return False
+    return True
+
+
+# Cycle through files using a pool of worker processes, one (file, plane) pair per task.
+# Results are merged back in file and plane order, so the output matches a serial run.
+def cyclefiles_parallel(run, regioninput, spotinput, region_settings, spot_settings, output_params, one_per_cell,
+                        stopper, workers):
+    wantpreview, projection = output_params[0], output_params[4]
+    profile = None if run.profiler is None else run.profiler.memory
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'))
+
+    # Queue up files and planes in order. Planes are only submitted as the merge loop below asks for them.
+    def plantasks():
+        depth = run.currentdepth
+        for i in range(len(regioninput)):
+            numframes, planes, message = getplanes(regioninput[i], spotinput[i], output_params)
+            groups = planegroups(planes, projection)
+            remaining = [planeid for planeid in groups if not run.isdone(regioninput[i], planeid)]
+            notes = []
+            if len(remaining) < len(groups):
+                notes.append(f"Skipping {len(groups) - len(remaining)} planes completed earlier")
+            regionsettings, spotsettings = region_settings, spot_settings
+            if remaining:
+                regionsettings, spotsettings, stacknotes = sharedthresholds(
+                    run, [(regioninput[i], spotinput[i], planes)], region_settings, spot_settings, 'stack', stopper,
+                    projection)
+                notes += stacknotes
+                depth = max(depth, run.currentdepth)  # Sampling for a shared threshold may have raised it.
+            starts = [depth] * len(remaining)
+            if remaining and not run.manualdepth:
+                starts, depth = startdepths(regioninput[i], spotinput[i], groups, remaining, projection, depth)
+            if projection and numframes is not None:
+                numframes = len(groups)
+            yield 'file', i, numframes, message, notes
+            for planeid, start in zip(remaining, starts):
+                yield 'plane', i, executor.submit(analyseplane, regioninput[i], spotinput[i], planeid,
+                                                  regionsettings, spotsettings, wantpreview, one_per_cell,
+                                                  (start, run.manualdepth), profile, groups[planeid], projection,
+                                                  run.measuremode)
+
+    tasks = plantasks()
+    queued = deque()
+    alldone = False
+    while True:
+        # Keep a couple of planes per worker in flight.
+        while not alldone and sum(1 for item in queued if item[0] == 'plane') < workers * 2:
+            item = next(tasks, None)
+            if item is None:
+                alldone = True
+            else:
+                queued.append(item)
+        if not queued:
+            break
+        item = queued.popleft()
+        if item[0] == 'file':
+            tasktype, index, numframes, message, notes = item
+            run.logevent(f"Analysing {regioninput[index]}")
+            run.imgfile = regioninput[index]
+            if numframes is None:
+                run.logevent(message)
+                continue
+            run.update_progress("file", numframes)
+            if message:
+                run.logevent(message)
+            for note in notes:
+                run.logevent(note)
+            continue
+        future = item[2]
+        while stopper.is_set() and not future.done():
+            wait([future], timeout=0.1)
+        if not stopper.is_set():  # Abandon any outstanding work.
+            future.cancel()
+            for pending in queued:
+                if pending[0] == 'plane':
+                    pending[2].cancel()
+            executor.shutdown(wait=False)
+            run.update_progress('finished', 0)
+            return
+        mergeplane(run, *future.result())
+        run.checkpoint()
+    executor.shutdown()
+
+
+# The bit depth each of planeids starts from in a serial run, which keeps the highest depth detected so far, see
+# AnalysisRun.bit_depth_update. Returns their depths and the depth after the last of them. Only plane maxima are
+# needed, so this is quick next to analysing them.
+def startdepths(regionimg, spotimg, groups, planeids, projection, depth):
+    starts = []
+    with TiffStack(regionimg) as img, TiffStack(spotimg) as img2:
+        for planeid in planeids:
+            starts.append(depth)
+            for stack in (img, img2):
+                depth = max(depth, detect_depth(projectplanes(stack, groups[planeid], projection)))
+    return starts, depth
+
+
+# Replay the events recorded while a worker analysed a plane, numbering cells and spots on from the current run.
+def mergeplane(run, planeid, events, numcells, numspots):
+    basecell = run.cellnum
+    baseindex = run.indexnum
+    run.currplane = planeid
+    for event in events:
+        if event[0] == 'log':
+            run.logevent(event[1])
+        elif event[0] == 'progress':
+            run.update_progress(event[1], event[2])
+        elif event[0] == 'row':
+            run.cellnum = basecell + event[1]
+            run.indexnum = baseindex + event[2]
+            run.datawriter(event[3])
+        elif event[0] == 'preview':
+            run.betterpreview(*event[1], baseindex + event[2], event[3])
+        elif event[0] == 'profile' and run.profiler is not None:
+            run.profiler.planes.append(event[1])
+        elif event[0] == 'depth':
+            run.currentdepth = max(run.currentdepth, event[1])
+    run.cellnum = basecell + numcells
+    run.indexnum = baseindex + numspots
+    run.flushdata()
+
+
+class WorkerRun(AnalysisRun):
+    # Used by worker processes. Log messages, progress, results and previews are recorded for the main process
+    # to replay. Bit depth starts from the depth a serial run would have reached by the plane, see startdepths.
+    def __init__(self, depth, profile=None):
+        AnalysisRun.__init__(self)
+        self.currentdepth, self.manualdepth = depth
+        self.events = []
+        if profile is not None:
+            self.profiler = StageProfiler(profile)
+
+    def logevent(self, text):
+        self.events.append(('log', text))
+
+    def update_progress(self, updatetype, limit):
+        self.events.append(('progress', updatetype, limit))
+
+    def datawriter(self, exportdata):
+        self.events.append(('row', self.cellnum, self.indexnum, exportdata))
+
+    def betterpreview(self, regioninput, spotinput, centcoord, perimcoord, spotcoord, name, multiplier):
+        self.events.append(('preview', (regioninput, spotinput, centcoord, perimcoord, spotcoord), name, multiplier))
+
 
+# Analyse a single plane in a worker process, or a projection of planeids. Profile is None, or whether to profile
+# memory use as well as time.
+def analyseplane(regionimg, spotimg, planeid, region_settings, spot_settings, wantpreview, one_per_cell, depth,
+                 profile=None, planeids=None, projection=None, measuremode='perimeter'):
+    run = WorkerRun(depth, profile)
+    run.measuremode = measuremode
+    run.currplane = planeid
+    run.imgfile = regionimg
+    planeids = planeids or [planeid]
+    with TiffStack(regionimg) as img, TiffStack(spotimg) as img2:
+        im = projectplanes(img, planeids, projection)
+        im2 = projectplanes(img2, planeids, projection)
+    if len(planeids) > 1:
+        run.logevent(f"Analysing {projection} projection of {len(planeids)} planes")
+    multiplier, absolute_min = run.bit_depth_update(im)
+    stopper = Event()
+    stopper.set()
+    if run.profiler is not None:
+        run.profiler.start()
+    cyclecells(run, im, im2, region_settings, spot_settings, wantpreview, one_per_cell, stopper, multiplier)
+    if run.profiler is not None:
+        run.profiler.stop()
+        run.events.extend(('profile', plane) for plane in run.profiler.planes)
+    run.events.append(('depth', run.currentdepth))
+    return planeid, run.events, run.cellnum, run.indexnum
 
-# File List Generator
-def genfilelist(tgtdirectory, subdirectories, regnkwd, spotkwd, mode):
+
+# Output file columns, with the type used when saving in a columnar format.
+headings = ('File', 'Plane', 'Cell ID', 'Spot ID', 'Region Area', 'Spot Area', 'Spot Average Intensity',
+            'Spot Integrated Intensity', 'Perimeter -> Centroid', 'Perimeter -> Spot', 'Spot -> Centroid',
+            'Percent Migration')
+columntypes = (str, 'int64', 'int64', 'int64', 'int64', 'int64', 'float64', 'float64', 'float64', 'float64',
+               'float64', 'float64')
+columnarformats = ('npz', 'parquet')
+
+
+class ResultWriter:
+    # Buffers result rows and appends them to the CSV file in bulk. If a columnar format (.npz, or .parquet if pyarrow
+    # is installed) is requested, typed copies of each column are also kept so the results can be saved in it when a
+    # run finishes.
+    def __init__(self, path, columnar=None, run=None, flushrows=1000):
+        self.path = path
+        self.run = run
+        self.columnar = columnar
+        self.flushrows = flushrows
+        self.rows = []
+        self.chunks = []
+        self.earlier = 0  # Bytes of results at the start of the file which aren't kept, e.g. from a resumed run.
+
+    # Write the column headings, replacing any existing file.
+    def headers(self):
+        try:
+            with open(self.path, 'w', newline="\n", encoding="utf-8") as f:
+                headerwriter = csvwriter(f)
+                headerwriter.writerow(headings)
+        except AttributeError:
+            self.logevent("Directory appears to be invalid")
+        except PermissionError:
+            self.logevent("Unable to write to save file. Please check write permissions.")
+        except OSError:
+            self.logevent("OSError, failed to write to save file.")
+
+    def logevent(self, text):
+        if self.run is not None:
+            self.run.logevent(text)
+        else:
+            print(text)
+
+    # Queue a row, writing out the queue once it gets long enough.
+    def addrow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flushrows:
+            self.flush()
+
+    # Write out queued rows. If the file can't be written to they're kept for the next attempt.
+    def flush(self):
+        if not self.rows:
+            return
+        try:
+            with open(self.path, 'a', newline="\n", encoding="utf-8") as f:
+                mainwriter = csvwriter(f)
+                mainwriter.writerows(self.rows)
+            written = os.path.getsize(self.path)
+        except AttributeError:
+            self.logevent("Directory appears to be invalid")
+            return
+        except PermissionError:
+            self.logevent("Unable to write to save file. Please check write permissions.")
+            return
+        except OSError:
+            self.logevent("OSError, failed to write to save file.")
+            return
+        if self.columnar in columnarformats:
+            self.chunks.append([np.array(values, dtype=dtype) for values, dtype in zip(zip(*self.rows), columntypes)])
+        else:  # Read back from the file instead if a columnar format is requested later on.
+            self.chunks = []
+            self.earlier = written
+        self.rows = []
+
+    # Cut the file back to a length recorded when resuming a run, dropping any rows written after it.
+    def truncate(self, offset):
+        self.rows = []
+        self.chunks = []
+        try:
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+        except OSError:
+            self.logevent("OSError, failed to resume save file.")
+        self.earlier = offset
+
+    # Read back the results which weren't kept, see earlier.
+    def earlierrows(self):
+        with open(self.path, 'rb') as f:
+            text = f.read(self.earlier).decode('utf-8')
+        rows = list(csvreader(text.splitlines()))[1:]  # Skip the headings.
+        return [np.array(values, dtype=dtype) for values, dtype in zip(zip(*rows), columntypes)] if rows else None
+
+    # Flush any queued rows and save all results so far in the columnar format, if one was requested.
+    def finish(self):
+        self.flush()
+        if self.columnar not in columnarformats:
+            return
+        if self.earlier:
+            try:
+                earlier = self.earlierrows()
+            except OSError:
+                self.logevent("OSError, failed to read earlier results from save file.")
+                return
+            if earlier is not None:
+                self.chunks.insert(0, earlier)
+            self.earlier = 0
+        columns = {name: np.concatenate([chunk[i] for chunk in self.chunks]) if self.chunks else
+                   np.array([], dtype=dtype) for i, (name, dtype) in enumerate(zip(headings, columntypes))}
+        fileformat = self.columnar
+        if fileformat == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                self.logevent("Parquet output needs the pyarrow package, saving as .npz instead.")
+                fileformat = 'npz'
+        savetgt = os.path.splitext(self.path)[0] + '.' + fileformat
+        try:
+            if fileformat == 'parquet':
+                pyarrow.parquet.write_table(pyarrow.table(columns), savetgt)
+            else:
+                np.savez(savetgt, **columns)
+        except PermissionError:
+            self.logevent("Unable to write to " + savetgt + ". Please check write permissions.")
+        except OSError:
+            self.logevent("OSError, failed to write to " + savetgt)
+
+
+class RunJournal:
+    # Records each plane as it's completed, along with the length of the output file and the run's counters at that
+    # point, so that an interrupted run can be resumed. Entries are saved as one JSON object per line. If the output
+    # file turns out shorter than an entry says (e.g. it wasn't all saved to disk before a crash), that entry and
+    # those after it are ignored.
+    def __init__(self, path):
+        self.path = path
+        self.done = {}  # (file, plane ID): settings key, for planes completed by earlier runs.
+
+    # Start a new, empty journal.
+    def start(self):
+        self.done = {}
+        try:
+            open(self.path, 'w').close()
+        except OSError:
+            pass  # The run still works without one, it just can't be resumed.
+
+    # Read the journal, keeping entries which fit in an output file of the given size. Returns the last of them, or
+    # None if there are none.
+    def load(self, filesize):
+        entries = []
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                for text in f:
+                    try:
+                        entry = json.loads(text)
+                    except ValueError:
+                        break  # Partly written.
+                    if entry['offset'] > filesize:
+                        break
+                    entries.append(entry)
+        except OSError:
+            return None
+        self.done = {(entry['file'], entry['plane']): entry['settings'] for entry in entries}
+        try:
+            with open(self.path, 'w', encoding="utf-8") as f:  # Drop anything which was ignored.
+                f.writelines(json.dumps(entry) + "\n" for entry in entries)
+        except OSError:
+            pass
+        return entries[-1] if entries else None
+
+    def record(self, run):
+        try:
+            entry = {'file': run.imgfile, 'plane': run.currplane, 'settings': run.settingskey,
+                     'offset': os.path.getsize(run.writer.path), 'cellnum': run.cellnum, 'indexnum': run.indexnum,
+                     'depth': run.currentdepth}
+            with open(self.path, 'a', encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError:
+            return
+        self.done[(run.imgfile, run.currplane)] = run.settingskey
+
+
+previewlayouts = ('files', 'stack', 'sheet')  # One file per spot, a multi-page TIFF or a contact sheet per plane.
+
+
+class PreviewWriter:
+    # Saves result images on background threads, so the analysis doesn't wait for the disk. Images are handed over
+    # through a bounded queue, which holds up the analysis if the disk can't keep up.
+    # In the 'stack' and 'sheet' layouts the images for a plane are collected and saved together, as a multi-page
+    # TIFF or a single contact sheet image, when the plane ends. Images appear in spot ID order and the file is named
+    # after the image file, plane and range of spot IDs.
+    def __init__(self, previewdir, layout='files', run=None, threads=2, queuesize=64):
+        self.previewdir = previewdir
+        self.layout = layout
+        self.run = run
+        self.queue = Queue(maxsize=queuesize)
+        self.errors = []  # Messages from the writer threads, reported from the analysis thread.
+        self.batch = []
+        self.threads = [Thread(target=self.work, daemon=True) for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def logevent(self, text):
+        if self.run is not None:
+            self.run.logevent(text)
+        else:
+            print(text)
+
+    # Queue a spot's result image. Details are the arguments to previewimage.
+    def add(self, details, name):
+        if self.layout == 'files':
+            self.queue.put(('file', details, self.previewdir + str(name)))
+        else:
+            self.batch.append((details, name))
+        self.report()
+
+    # Save the images collected for the current plane.
+    def endplane(self):
+        if self.batch:
+            first, last = self.batch[0][1], self.batch[-1][1]
+            if self.run is not None:
+                stem = os.path.splitext(os.path.basename(self.run.imgfile))[0]
+                stem += "_plane" + str("%03d" % (self.run.currplane + 1)) + "_"
+            else:
+                stem = ""
+            savename = self.previewdir + stem + "spots" + str(first) + "-" + str(last)
+            self.queue.put((self.layout, [details for details, name in self.batch], savename))
+            self.batch = []
+        self.report()
+
+    # Finish saving everything queued and stop the writer threads.
+    def close(self):
+        self.endplane()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.report()
+
+    # Pass on any errors from the writer threads.
+    def report(self):
+        while self.errors:
+            self.logevent(self.errors.pop(0))
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            layout, details, savename = task
+            savetgt = savename + ".tif"
+            try:
+                if layout == 'file':
+                    Image.fromarray(previewimage(*details)).save(savetgt)
+                elif layout == 'stack':
+                    pages = [Image.fromarray(previewimage(*item)) for item in details]
+                    pages[0].save(savetgt, save_all=True, append_images=pages[1:])
+                else:
+                    Image.fromarray(contactsheet([previewimage(*item) for item in details])).save(savetgt)
+            except PermissionError:
+                self.errors.append("Unable to write to " + savetgt + ". Please check write permissions.")
+            except OSError:
+                self.errors.append("OSError, failed to write to " + savetgt)
+
+
+# Tile RGB images into a grid, in rows from the top left, with a 2 pixel gap between them.
+def contactsheet(images, gap=2):
+    tileheight = max(image.shape[0] for image in images) + gap
+    tilewidth = max(image.shape[1] for image in images) + gap
+    columns = ceil(sqrt(len(images)))
+    rows = ceil(len(images) / columns)
+    sheet = np.zeros((rows * tileheight - gap, columns * tilewidth - gap, 3), 'uint8')
+    for i, image in enumerate(images):
+        top = (i // columns) * tileheight
+        left = (i % columns) * tilewidth
+        sheet[top:top + image.shape[0], left:left + image.shape[1]] = image
+    return sheet
+
+
+# File List Generator. Finds files for both channels in one pass over the directory tree. An index can be passed to
+# reuse listings of directories which haven't changed since they were last scanned, see FileIndex.
+def genfilelist(tgtdirectory, subdirectories, regnkwd, spotkwd, mode, index=None):
     regionfiles, regionshortnames, spotfiles, spotshortnames = [],[],[],[]
-    regnfilelist = [(os.path.normpath(os.path.join(root, f)),
-                     (".." + (os.path.join((os.path.relpath(root, tgtdirectory)), f))[-50:])) for root, dirs, files in
-                    os.walk(tgtdirectory) for f in files if
-                    f.lower().endswith((".tif", ".tiff")) and not f.startswith(".") and regnkwd in (
-                        f if mode == 0 else (os.path.join((os.path.relpath(root, tgtdirectory)), f) if mode == 1 else (
-                            os.path.join(root, f)))) and (root == tgtdirectory or subdirectories)]
-    spotfilelist = [(os.path.normpath(os.path.join(root, f)),
-                     (".." + (os.path.join((os.path.relpath(root, tgtdirectory)), f))[-50:])) for root, dirs, files in
-                    os.walk(tgtdirectory) for f in files if
-                    f.lower().endswith((".tif", ".tiff")) and not f.startswith(".") and spotkwd in (
-                        f if mode == 0 else (os.path.join((os.path.relpath(root, tgtdirectory)), f) if mode == 1 else (
-                            os.path.join(root, f)))) and (root == tgtdirectory or subdirectories)]
-    if len(regnfilelist) > 0:
-        regionfiles, regionshortnames = [list(x) for x in zip(*regnfilelist)]
-    if len(spotfilelist) > 0:
-        spotfiles, spotshortnames = [list(x) for x in zip(*spotfilelist)]
+    if index is None:
+        index = FileIndex()
+    for root, files in index.walk(tgtdirectory, subdirectories):
+        relroot = os.path.relpath(root, tgtdirectory)
+        for f in files:
+            relpath = os.path.join(relroot, f)
+            searched = f if mode == 0 else (relpath if mode == 1 else os.path.join(root, f))
+            inregion, inspot = regnkwd in searched, spotkwd in searched
+            if not (inregion or inspot):
+                continue
+            path = os.path.normpath(os.path.join(root, f))
+            shortname = ".." + relpath[-50:]
+            if inregion:
+                regionfiles.append(path)
+                regionshortnames.append(shortname)
+            if inspot:
+                spotfiles.append(path)
+                spotshortnames.append(shortname)
+    index.save()
     return regionfiles, spotfiles, regionshortnames, spotshortnames
+
+
+# Where the GUI keeps its FileIndex between sessions.
+fileindexpath = os.path.join(os.path.expanduser("~"), ".spotmeasure", "fileindex.json")
+
+
+class FileIndex:
+    # Lists of the TIFF files and subdirectories in each directory scanned, along with the directory's modification
+    # time. When a tree is scanned again, only directories whose modification time has changed are listed again.
+    # With a path the index is loaded from and saved to that file, so it carries over between sessions.
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}  # Absolute path: [modification time, time listed, TIFF file names, (subdirectory, link)]
+        self.changed = False
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                pass  # Missing or damaged, start a new one.
+
+    # Walk a directory tree top down in the same order as os.walk, giving (directory, TIFF file names) for each.
+    # Links to directories are listed but not followed. Directories which can't be read are skipped.
+    def walk(self, top, subdirectories=True):
+        pending = [top]
+        while pending:
+            directory = pending.pop()
+            listing = self.listdir(directory)
+            if listing is None:
+                continue
+            files, subdirs = listing
+            yield directory, files
+            if subdirectories:
+                pending.extend(os.path.join(directory, name) for name, islink in reversed(subdirs) if not islink)
+
+    # TIFF files and subdirectories in a directory, from the index if it hasn't changed. Directories which changed
+    # within two seconds of being listed are always listed again, as they could have changed since without their
+    # modification time moving on.
+    def listdir(self, directory):
+        key = os.path.abspath(directory)
+        try:
+            modified = os.stat(directory).st_mtime_ns
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == modified and entry[1] - modified > 2e9:
+                return entry[2], entry[3]
+            listed = time.time_ns()
+            files, subdirs = [], []
+            with os.scandir(directory) as items:
+                for item in items:
+                    try:
+                        if item.is_dir():
+                            subdirs.append((item.name, item.is_symlink()))
+                            continue
+                    except OSError:
+                        pass
+                    if item.name.lower().endswith((".tif", ".tiff")) and not item.name.startswith("."):
+                        files.append(item.name)
+        except OSError:
+            return None
+        self.entries[key] = [modified, listed, files, subdirs]
+        self.changed = True
+        return files, subdirs
+
+    # Save the index if anything changed. The file is replaced in one step so it can't be left half written.
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(self.path + ".tmp", self.path)
+            self.changed = False
+        except OSError:
+            pass  # The index is only there to save time.
+
+
+# Command line interface for batch runs without the GUI, e.g. "python -m measurescript <directory> -o output.csv"
+def main(argv=None):
+    parser = ArgumentParser(prog="measurescript", description="Measure how far into regions spots are located.")
+    parser.add_argument("directory", help="directory containing the images to analyse")
+    parser.add_argument("-o", "--output", required=True, help="CSV file to write results to")
+    parser.add_argument("--region-keyword", default="Blue", help="keyword identifying region images")
+    parser.add_argument("--spot-keyword", default="_Red", help="keyword identifying spot images")
+    parser.add_argument("--search", choices=("name", "subdirectory", "path"), default="name",
+                        help="where to look for keywords: file name, name + subdirectory or the full path")
+    parser.add_argument("--no-subdirectories", action="store_true", help="don't search subdirectories for images")
+    parser.add_argument("--bit-depth", choices=("auto", "8", "10", "12", "16"), default="auto")
+    for imgtype, method, threshold, smoothing, minsize in (("region", "High", 16, 10, 1000),
+                                                           ("spot", "Low", 32, 1, 10)):
+        parser.add_argument(f"--{imgtype}-method", choices=("High", "Low", "Manual"), default=method,
+                            help=f"{imgtype} thresholding: High (method 1), Low (method 2) or Manual")
+        parser.add_argument(f"--{imgtype}-threshold", type=int, default=threshold,
+                            help=f"{imgtype} threshold for Manual mode, minimum threshold otherwise")
+        parser.add_argument(f"--{imgtype}-smoothing", type=float, default=smoothing)
+        parser.add_argument(f"--{imgtype}-minsize", type=int, default=minsize, help=f"minimum {imgtype} size")
+        parser.add_argument(f"--{imgtype}-scope", choices=thresholdscopes, default="plane",
+                            help=f"calculate automatic {imgtype} thresholds for each plane, or once per stack or "
+                                 f"for the whole batch")
+    parser.add_argument("--spot-prefilter", choices=spotprefilters, default="rank",
+                        help="peak filter used for automatic spot thresholds: rank (original), square or "
+                             "downsampled (faster)")
+    parser.add_argument("--threshold-samples", type=int, default=100000,
+                        help="pixels sampled from each plane (or tile) for stack, batch and tiled thresholds "
+                             "(0 for all)")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="segment in single precision, one object at a time, to reduce memory use")
+    parser.add_argument("--tile-size", type=int, default=0,
+                        help="segment images larger than this in overlapping tiles of this size (0 for never)")
+    parser.add_argument("--tile-halo", type=int, default=256,
+                        help="margin around each tile, which should be wider than the largest objects")
+    parser.add_argument("--previews", metavar="DIRECTORY", help="save result images to this directory")
+    parser.add_argument("--preview-layout", choices=previewlayouts, default="files",
+                        help="save result images as one file per spot, or one multi-page TIFF (stack) or contact "
+                             "sheet image (sheet) per plane")
+    parser.add_argument("--one-per-cell", action="store_true", help="only analyse cells containing a single spot")
+    parser.add_argument("--measure", choices=measuremodes, default="perimeter",
+                        help="measure spots along the line from the cell centroid to the perimeter, or by their "
+                             "distance to the nearest edge of the cell (faster)")
+    parser.add_argument("--plane", type=int, help="only analyse this plane (numbered from 1)")
+    parser.add_argument("--focus-planes", type=int, default=0, metavar="N",
+                        help="only analyse the N best focused planes of each stack, judged from the region images")
+    parser.add_argument("--projection", choices=projections,
+                        help="analyse one image projected from the planes of each stack instead of every plane")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--columnar", choices=columnarformats,
+                        help="also save results in a typed columnar format next to the CSV file")
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on from where an interrupted run into the same output file stopped")
+    parser.add_argument("--profile", nargs="?", const="memory", choices=("time", "memory"),
+                        help="report time (and by default memory) used by each analysis stage")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep analysing new images as they are saved into the directory, until interrupted "
+                             "with Ctrl+C")
+    parser.add_argument("--watch-interval", type=float, default=5, help="seconds between checks for new images")
+    parser.add_argument("--settle", type=float, default=10,
+                        help="seconds a new image must stay unchanged before it is analysed")
+    args = parser.parse_args(argv)
+
+    searchmode = ("name", "subdirectory", "path").index(args.search)
+    if not args.watch:
+        regionfiles, spotfiles, regionshortnames, spotshortnames = genfilelist(
+            args.directory, not args.no_subdirectories, args.region_keyword, args.spot_keyword, searchmode)
+        regionfiles.sort()  # Pair files up by sorted path, as there's no chance to rearrange the lists by hand.
+        spotfiles.sort()
+        if len(regionfiles) != len(spotfiles):
+            print(f"{abs(len(regionfiles) - len(spotfiles))} unpaired files will be skipped")
+        numpairs = min(len(regionfiles), len(spotfiles))
+        if numpairs == 0:
+            print("Unable to run: No file list generated")
+            return 1
+    prevdir = os.path.join(args.previews, "") if args.previews else ""
+    run = AnalysisRun(args.output, prevdir, args.columnar, profile=args.profile, previewlayout=args.preview_layout,
+                      measuremode=args.measure)
+    if args.bit_depth != "auto":
+        run.currentdepth = ("8", "10", "12", "16").index(args.bit_depth)
+        run.manualdepth = True
+    region_settings = SegSettings(args.region_method, args.region_threshold, args.region_smoothing,
+                                  args.region_minsize, scope=args.region_scope, samples=args.threshold_samples,
+                                  lowmemory=args.low_memory, tilesize=args.tile_size, tilehalo=args.tile_halo)
+    spot_settings = SegSettings(args.spot_method, args.spot_threshold, args.spot_smoothing, args.spot_minsize,
+                                args.spot_prefilter, args.spot_scope, args.threshold_samples, args.low_memory,
+                                args.tile_size, args.tile_halo)
+    output_params = (args.previews is not None, args.plane is not None, (args.plane or 1) - 1, args.focus_planes,
+                     args.projection)
+    if not (args.resume and run.resume()):
+        run.headers()
+    stopper = Event()
+    stopper.set()
+    if args.watch:
+        try:
+            watchfolder(run, args.directory, not args.no_subdirectories, args.region_keyword, args.spot_keyword,
+                        searchmode, region_settings, spot_settings, output_params, args.one_per_cell, stopper,
+                        args.workers, args.watch_interval, args.settle)
+        except KeyboardInterrupt:  # Results so far have been written out by now.
+            print("Stopped watching")
+        return 0
+    cyclefiles(run, regionfiles[:numpairs], spotfiles[:numpairs], region_settings, spot_settings, output_params,
+               args.one_per_cell, stopper, workers=args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,30 @@
+# Checks that segmenting in tiles gives the same cells as segmenting the whole image.
+# Usage: python -m pytest test_tiling.py
+
+import numpy as np
+from scipy import ndimage as ndi
+
+import measurescript as ms
+
+
+# Cells on a blurred, noisy background, with the first one centred on the corner where four 200 pixel tiles meet.
+def makeimage():
+    rng = np.random.RandomState(0)
+    image = np.zeros((512, 512))
+    rows, cols = np.ogrid[:512, :512]
+    centres = [(200, 200)] + [tuple(rng.randint(40, 472, 2)) for i in range(12)]
+    for row, col in centres:
+        image[(rows - row) ** 2 + (cols - col) ** 2 <= 30 ** 2] = rng.uniform(2000, 2500)
+    image = ndi.gaussian_filter(image, 1.5) + rng.normal(100, 20, image.shape)
+    return np.clip(image, 0, 4095).astype(np.uint16)
+
+
+def test_cell_across_tile_corner():
+    image = makeimage()
+    settings = ms.SegSettings("Manual", 679, 10, 1000)
+    for lowmemory in (False, True):
+        whole = ms.segment(image, settings._replace(lowmemory=lowmemory), 'region', (16, 256))[0]
+        tiled = ms.segment(image, settings._replace(lowmemory=lowmemory, tilesize=200, tilehalo=256), 'region',
+                           (16, 256))[0]
+        assert whole[200, 200] > 0
+        assert np.array_equal(whole, tiled)
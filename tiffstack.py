@@ -0,0 +1,140 @@
+# Reader for multi-page TIFF stacks.
+# The page directories (IFDs) are parsed once when a file is opened. Uncompressed greyscale planes stored in one
+# contiguous block are returned as read-only NumPy views of a memory map of the file, with no decoding or copying.
+# Anything else (compressed, tiled, colour or inverted images) is decoded with PIL instead.
+
+import mmap
+import struct
+
+import numpy as np
+from PIL import Image
+
+# Field types which may hold the tags we need, as struct formats.
+fieldformats = {1: 'B', 3: 'H', 4: 'I', 13: 'I', 16: 'Q', 18: 'Q'}
+fieldsizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8}
+# Tags used to locate plane data.
+IMAGEWIDTH, IMAGELENGTH, BITSPERSAMPLE, COMPRESSION, PHOTOMETRIC = 256, 257, 258, 259, 262
+STRIPOFFSETS, SAMPLESPERPIXEL, STRIPBYTECOUNTS, TILEWIDTH, SAMPLEFORMAT = 273, 277, 279, 322, 339
+
+
+class TiffStack:
+    # Open a TIFF stack. Raises OSError if the file can't be read as an image, like PIL.Image.open.
+    def __init__(self, path):
+        self.path = path
+        self.pilimage = None
+        self.map = None
+        self.pages = []
+        with open(path, 'rb') as f:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file.
+                raise OSError("Cannot read empty file " + str(path))
+        try:
+            self.pages = self.readpages()
+        except (struct.error, ValueError, KeyError):
+            self.pages = None
+        if not self.pages:  # Not a TIFF file we can parse, let PIL have a go.
+            self.pages = None
+            self.map = None
+            self.pilimage = Image.open(path)
+            self.n_frames = getattr(self.pilimage, 'n_frames', 1)
+            self.mode = self.pilimage.mode
+            return
+        self.n_frames = len(self.pages)
+        if self.pages[0][0] is not None:
+            self.mode = self.pages[0][0]
+        else:
+            self.mode = self.pil().mode
+
+    # Walk the chain of image file directories, recording where each plane's data can be found.
+    def readpages(self):
+        mm = self.map
+        byteorder = {b'II': '<', b'MM': '>'}.get(mm[:2])
+        if byteorder is None:
+            return None
+        version = struct.unpack_from(byteorder + 'H', mm, 2)[0]
+        if version == 42:  # Classic TIFF
+            countformat, entryformat, offsetformat, entrysize = 'H', 'HHI', 'I', 12
+            nextifd = struct.unpack_from(byteorder + 'I', mm, 4)[0]
+        elif version == 43:  # BigTIFF, used for files over 4GB.
+            countformat, entryformat, offsetformat, entrysize = 'Q', 'HHQ', 'Q', 20
+            nextifd = struct.unpack_from(byteorder + 'Q', mm, 8)[0]
+        else:
+            return None
+        valuesize = struct.calcsize(offsetformat)
+        countsize = struct.calcsize(countformat)
+        pages = []
+        seen = set()
+        while nextifd and nextifd not in seen:
+            seen.add(nextifd)
+            numentries = struct.unpack_from(byteorder + countformat, mm, nextifd)[0]
+            tags = {}
+            for entry in range(numentries):
+                position = nextifd + countsize + entry * entrysize
+                tag, fieldtype, count = struct.unpack_from(byteorder + entryformat, mm, position)
+                if fieldtype not in fieldformats:
+                    continue
+                datasize = fieldsizes[fieldtype] * count
+                if datasize <= valuesize:  # Small values are stored in the entry itself.
+                    dataoffset = position + entrysize - valuesize
+                else:
+                    dataoffset = struct.unpack_from(byteorder + offsetformat, mm, position + entrysize - valuesize)[0]
+                tags[tag] = struct.unpack_from(byteorder + fieldformats[fieldtype] * count, mm, dataoffset)
+            pages.append(self.locateplane(tags, byteorder))
+            nextifd = struct.unpack_from(byteorder + offsetformat, mm,
+                                         nextifd + countsize + numentries * entrysize)[0]
+        return pages
+
+    # Work out whether a plane can be mapped directly. Returns (mode, dtype, shape, offset), with None in place of
+    # the mode if the plane has to be decoded.
+    def locateplane(self, tags, byteorder):
+        width = tags[IMAGEWIDTH][0]
+        height = tags[IMAGELENGTH][0]
+        bits = tags.get(BITSPERSAMPLE, (1,))[0]
+        samples = tags.get(SAMPLESPERPIXEL, (1,))[0]
+        sampleformat = tags.get(SAMPLEFORMAT, (1,))[0]
+        mapped = (tags.get(COMPRESSION, (1,))[0] == 1 and tags.get(PHOTOMETRIC, (1,))[0] == 1 and samples == 1
+                  and sampleformat == 1 and bits in (8, 16) and TILEWIDTH not in tags and STRIPOFFSETS in tags)
+        if not mapped:
+            return None, None, (height, width), None
+        dtype = np.dtype(np.uint8) if bits == 8 else np.dtype(byteorder + 'u2')
+        offsets = tags[STRIPOFFSETS]
+        counts = tags.get(STRIPBYTECOUNTS, (width * height * dtype.itemsize,))
+        # Strips must follow on from each other with nothing in between.
+        contiguous = all(offsets[i] + counts[i] == offsets[i + 1] for i in range(len(offsets) - 1))
+        if not contiguous or sum(counts) < width * height * dtype.itemsize or \
+                offsets[0] + width * height * dtype.itemsize > len(self.map):
+            return None, None, (height, width), None
+        if bits == 8:
+            mode = 'L'
+        else:
+            mode = 'I;16' if byteorder == '<' else 'I;16B'
+        return mode, dtype, (height, width), offsets[0]
+
+    # Fetch a plane as a NumPy array. Mapped planes are read-only views, so copy them before modifying.
+    def plane(self, index):
+        if self.pages is not None:
+            mode, dtype, shape, offset = self.pages[index]
+            if mode is not None:
+                return np.ndarray(shape, dtype=dtype, buffer=self.map, offset=offset)
+        image = self.pil()
+        image.seek(index)
+        return np.array(image)
+
+    # PIL image used to decode planes which can't be mapped.
+    def pil(self):
+        if self.pilimage is None:
+            self.pilimage = Image.open(self.path)
+        return self.pilimage
+
+    def close(self):
+        if self.pilimage is not None:
+            self.pilimage.close()
+        # Planes handed out keep a reference to the map, so it is unmapped once the last of them is released.
+        self.map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *unusedargs):
+        self.close()